@@ -1,14 +1,31 @@
+import os
+import math
 import logging
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 
-from recommend.recommender import RecommenderWrapper
+from recommend.recommender import ModelRegistry, RecommenderWrapper
+from recommend.scheduler import MicroBatchScheduler
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-wrapper = RecommenderWrapper()
+# Load every checkpoint once at startup and keep it resident.
+# Memory mapped checkpoints are shared by all worker processes on the host.
+MMAP_CHECKPOINTS = os.getenv('RECOMMEND_MMAP', '1') == '1'
+registry = ModelRegistry(preload=True, mmap=MMAP_CHECKPOINTS)
+wrapper = RecommenderWrapper(registry)
+
+# Optional micro-batching of concurrent /api/recommend calls, enabled with a positive window
+BATCH_WINDOW_MS = float(os.getenv('RECOMMEND_BATCH_WINDOW_MS', '0'))
+BATCH_MAX_SIZE = int(os.getenv('RECOMMEND_BATCH_MAX_SIZE', '32'))
+scheduler = MicroBatchScheduler(wrapper, BATCH_MAX_SIZE, BATCH_WINDOW_MS) if BATCH_WINDOW_MS > 0 else None
+
+VALID_MODELS = ['EASE', 'ItemKNN', 'NeuralMF', 'DeepFM']
+DEFAULT_TOP_K = 10
+DEFAULT_NUM_CANDIDATES = 200
+MAX_BATCH_SIZE = 10000
 
 app = Flask(__name__)
 cors = CORS(app)
@@ -48,9 +65,22 @@ def recommend():
         user_context = data['context']
         model = data['model']
         
-        # Validate model name
-        valid_models = ['EASE', 'ItemKNN', 'NeuralMF', 'DeepFM']  # Added placeholder for neural models
-        if model not in valid_models:
+        # Validate model name, or model weights of a blend such as {"EASE": 0.7, "ItemKNN": 0.3}
+        valid_models = VALID_MODELS
+        if isinstance(model, dict):
+            if not model or any(name not in valid_models for name in model):
+                return jsonify({
+                    'error': 'INVALID_MODEL',
+                    'message': f'Blended models must be a non-empty subset of {valid_models}',
+                    'available_models': valid_models
+                }), 400
+            if any(isinstance(weight, bool) or not isinstance(weight, (int, float)) or not math.isfinite(weight)
+                   or weight <= 0 for weight in model.values()):
+                return jsonify({
+                    'error': 'INVALID_WEIGHTS',
+                    'message': 'Model weights must be positive numbers'
+                }), 400
+        elif model not in valid_models:
             return jsonify({
                 'error': 'INVALID_MODEL',
                 'message': f'Model must be one of {valid_models}',
@@ -66,10 +96,39 @@ def recommend():
                 'message': 'Context must be an array of integers (movie IDs)'
             }), 400
         
+        # Optional two-stage mode: candidate_model retrieves candidates, model reranks them
+        candidate_model = data.get('candidate_model')
+        if candidate_model is not None and isinstance(model, dict):
+            return jsonify({
+                'error': 'INVALID_MODEL',
+                'message': 'candidate_model cannot be combined with a blended model'
+            }), 400
+        if candidate_model is not None and candidate_model not in valid_models:
+            return jsonify({
+                'error': 'INVALID_MODEL',
+                'message': f'Candidate model must be one of {valid_models}',
+                'available_models': valid_models
+            }), 400
+        try:
+            num_candidates = int(data.get('num_candidates', DEFAULT_NUM_CANDIDATES))
+            if num_candidates < 1:
+                raise ValueError
+        except (ValueError, TypeError):
+            return jsonify({
+                'error': 'INVALID_NUM_CANDIDATES',
+                'message': 'num_candidates must be a positive integer'
+            }), 400
+        
         # Get recommendations
         try:
-            wrapper.set_model(model)
-            result = wrapper.recommend(user_context)
+            if isinstance(model, dict):
+                result = wrapper.recommend_blend(model, user_context)
+            elif candidate_model is not None:
+                result = wrapper.recommend(model, user_context, candidate_model, num_candidates)
+            elif scheduler is not None:
+                result = scheduler.submit(model, user_context)
+            else:
+                result = wrapper.recommend(model, user_context)
             
             if not result:
                 return jsonify({
@@ -80,11 +139,15 @@ def recommend():
             
             logger.info(f"Generated {len(result)} recommendations using {model}")
             
-            return jsonify({
+            response = {
                 'result': result,
                 'model': model,
                 'count': len(result)
-            }), 200
+            }
+            if candidate_model is not None:
+                response['candidate_model'] = candidate_model
+                response['num_candidates'] = num_candidates
+            return jsonify(response), 200
             
         except KeyError as e:
             logger.error(f"Model {model} not found: {str(e)}")
@@ -93,6 +156,11 @@ def recommend():
                 'message': f'Model {model} is not available',
                 'available_models': valid_models
             }), 404
+        except ValueError as e:
+            return jsonify({
+                'error': 'INVALID_REQUEST',
+                'message': str(e)
+            }), 400
         except Exception as e:
             logger.error(f"Recommendation error: {str(e)}")
             return jsonify({
@@ -108,6 +176,105 @@ def recommend():
             'message': 'An unexpected error occurred'
         }), 500
 
+@app.route("/api/recommend/batch", methods=['POST'])
+def recommend_batch():
+    """Get recommendations for many contexts in one request"""
+    try:
+        data = request.get_json()
+
+        if not data:
+            return jsonify({
+                'error': 'MISSING_DATA',
+                'message': 'No data provided'
+            }), 400
+
+        if not data.get('contexts'):
+            return jsonify({
+                'error': 'MISSING_CONTEXTS',
+                'message': 'Contexts (list of movie ID lists) are required'
+            }), 400
+
+        if len(data['contexts']) > MAX_BATCH_SIZE:
+            return jsonify({
+                'error': 'BATCH_TOO_LARGE',
+                'message': f'At most {MAX_BATCH_SIZE} contexts are allowed per request'
+            }), 400
+
+        if 'model' not in data:
+            return jsonify({
+                'error': 'MISSING_MODEL',
+                'message': 'Model name is required'
+            }), 400
+
+        model = data['model']
+        if model not in VALID_MODELS:
+            return jsonify({
+                'error': 'INVALID_MODEL',
+                'message': f'Model must be one of {VALID_MODELS}',
+                'available_models': VALID_MODELS
+            }), 400
+
+        # Each entry is either a list of movie IDs or {"context": [...], "top_k": int}
+        contexts = []
+        top_ks = []
+        try:
+            default_top_k = int(data.get('top_k', DEFAULT_TOP_K))
+            for entry in data['contexts']:
+                if isinstance(entry, dict):
+                    context = entry.get('context')
+                    top_k = int(entry.get('top_k', default_top_k))
+                else:
+                    context = entry
+                    top_k = default_top_k
+                if not context or top_k < 1:
+                    raise ValueError
+                contexts.append([int(item) for item in context])
+                top_ks.append(top_k)
+        except (ValueError, TypeError, AttributeError):
+            return jsonify({
+                'error': 'INVALID_CONTEXT',
+                'message': 'Each context must be a non-empty array of integers (movie IDs) with a positive top_k'
+            }), 400
+
+        # Get recommendations
+        try:
+            results = wrapper.recommend_batch(model, contexts, top_ks)
+
+            logger.info(f"Generated recommendations for {len(results)} contexts using {model}")
+
+            return jsonify({
+                'results': results,
+                'model': model,
+                'count': len(results)
+            }), 200
+
+        except KeyError as e:
+            logger.error(f"Model {model} not found: {str(e)}")
+            return jsonify({
+                'error': 'MODEL_NOT_FOUND',
+                'message': f'Model {model} is not available',
+                'available_models': VALID_MODELS
+            }), 404
+        except ValueError as e:
+            return jsonify({
+                'error': 'INVALID_CONTEXT',
+                'message': str(e)
+            }), 400
+        except Exception as e:
+            logger.error(f"Batch recommendation error: {str(e)}")
+            return jsonify({
+                'error': 'RECOMMENDATION_ERROR',
+                'message': 'Failed to generate recommendations',
+                'details': str(e)
+            }), 500
+
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        return jsonify({
+            'error': 'INTERNAL_ERROR',
+            'message': 'An unexpected error occurred'
+        }), 500
+
 @app.route("/api/models", methods=['GET'])
 def get_models():
     """Get list of available recommendation models"""
@@ -115,11 +282,30 @@ def get_models():
         'models': [
             {'name': 'EASE', 'type': 'non-neural', 'description': 'Embarrassingly Shallow Autoencoders'},
             {'name': 'ItemKNN', 'type': 'non-neural', 'description': 'Item-based Collaborative Filtering'},
-            {'name': 'NeuralMF', 'type': 'neural', 'description': 'Neural Matrix Factorization (Coming Soon)'},
-            {'name': 'DeepFM', 'type': 'neural', 'description': 'Deep Factorization Machine (Coming Soon)'}
+            {'name': 'NeuralMF', 'type': 'neural', 'description': 'Matrix Factorization for implicit feedback (ALS)'},
+            {'name': 'DeepFM', 'type': 'neural', 'description': 'Deep Factorization Machine with genre, year, age and gender features'}
         ]
     }), 200
 
+@app.route("/api/models/stats", methods=['GET'])
+def get_model_stats():
+    """Get load time and memory footprint of resident models"""
+    return jsonify({
+        'models': registry.stats()
+    }), 200
+
+@app.route("/api/scheduler/metrics", methods=['GET'])
+def get_scheduler_metrics():
+    """Get batch size and queueing delay of the micro-batching scheduler"""
+    if scheduler is None:
+        return jsonify({
+            'enabled': False
+        }), 200
+    return jsonify({
+        'enabled': True,
+        'metrics': scheduler.metrics()
+    }), 200
+
 @app.route("/api/health", methods=['GET'])
 def health_check():
     """Health check endpoint"""
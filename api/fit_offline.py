@@ -1,6 +1,7 @@
 import os
 import sys
 import argparse
+from time import time
 from pathlib import Path
 
 WEB_DIR_PATH = Path(__file__).resolve().parents[1] / "backend"
@@ -14,40 +15,275 @@ from app.model import User, Movie, Interaction
 import numpy as np
 import scipy.sparse as sp
 from tqdm import tqdm
-from recommend.utils import load_rating_matrix_from_db, split_train_test
+from recommend.ann import recall_at_k
+from recommend.utils import load_rating_matrix_from_db, split_train_test, latest_interaction_time, load_interactions_since, load_interaction_timestamps
 from recommend.models import model_to_cls
-from recommend.evaluate import extract_top_k, evaluate
+from recommend.evaluate import evaluate_streaming, RankingEvaluator, METRICS
+from recommend.recommender import weight_arrays, rerank
+from recommend.dataset import RatingMatrixCache
+from recommend.gram import load_gram
+from recommend.features import load_features
+from recommend.pipeline import Split, parse_value, parse_grid, format_params, train_all, CheckpointWriter
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--model', type=str, default='ItemKNN')
+parser.add_argument('--model', type=str, default='ItemKNN', help='comma separated models trained on the same split, e.g. EASE,ItemKNN')
+parser.add_argument('--params', type=str, default='', help="model hyperparameters, e.g. reg=200,solver=cholesky; '|' separates grid values and ';' per-model grids, e.g. 'EASE:reg=100|300;ItemKNN:top_k=50|100'")
+parser.add_argument('--jobs', type=int, default=1, help='configurations trained concurrently, one process each')
+parser.add_argument('--cpus', type=int, default=None, help='cpus shared by the --jobs processes (default: all)')
 parser.add_argument('--save_dir', type=str, default='recommend/ckpt')
 parser.add_argument('--test_ratio', type=float, default=0.1)
+parser.add_argument('--split', type=str, default='random', choices=['random', 'leave_last', 'time_cutoff'], help='how test interactions are held out')
+parser.add_argument('--num_test', type=int, default=1, help='newest interactions held out per user with --split leave_last')
+parser.add_argument('--cutoff', type=int, default=None, help='first test timestamp with --split time_cutoff (default: the 1 - test_ratio quantile)')
+parser.add_argument('--seed', type=int, default=0, help='seed of the train/test split')
 parser.add_argument('--k', type=int, default=100)
-args = parser.parse_args()
+parser.add_argument('--eval_ks', type=str, default='', help='comma separated extra cutoffs evaluated from the same top-k lists, e.g. 10,20,50')
+parser.add_argument('--eval_chunk_size', type=int, default=1024, help='users scored per predict call during evaluation')
+parser.add_argument('--eval_threads', type=int, default=1, help='user chunks scored concurrently during evaluation')
+parser.add_argument('--cache_dir', type=str, default=None, help='keep a rating matrix snapshot here and only read newer interactions')
+parser.add_argument('--gram_cache_dir', type=str, default=None, help='cache the item x item Gram matrix of each training split here')
+parser.add_argument('--gram_jobs', type=int, default=1, help='processes the Gram matrix blocks are computed on')
+parser.add_argument('--save_state', action='store_true', help='also save the state used by --incremental')
+parser.add_argument('--incremental', action='store_true', help='update the saved model with interactions since its watermark')
+parser.add_argument('--check_drift', action='store_true', help='compare an incremental update against a full refit')
+parser.add_argument('--precision', type=str, default=None, help='store weights as float64, float32, float16 or int8')
+parser.add_argument('--reg_sweep', type=str, default='', help='comma separated EASE reg values evaluated from one eigendecomposition')
+parser.add_argument('--sweep_metric', type=str, default='ndcg', help='metric (at --k) used to pick the best reg and rank the trained models')
+parser.add_argument('--prune_top_k', type=int, default=None, help='also save EASE pruned to this many weights per item')
+parser.add_argument('--prune_threshold', type=float, default=None, help='drop pruned EASE weights below this magnitude')
+parser.add_argument('--ann_lists', type=int, default=0, help='lists of an IVF index built for embedding models and searched instead of scoring every item, e.g. the square root of the number of items (default 0: no index, exact search)')
+parser.add_argument('--ann_probes', type=str, default='1,2,4,8,16', help='comma separated n_probe values whose recall@k against exact search and latency are reported')
+parser.add_argument('--rerank_candidates', type=str, default='', help='comma separated ItemKNN candidate counts whose two-stage metrics and latency are reported next to full scoring, e.g. 100,200,500')
+parser.add_argument('--compare_precisions', type=str, default='', help='comma separated precisions to evaluate next to full precision')
 
-app = Flask(__name__)
-app.config.from_object(Config)
-app.app_context().push()
+def weight_mb(model):
+    return sum(array.nbytes for array in weight_arrays(model)) / 2**20
 
-db = SQLAlchemy()
-db.init_app(app)
+def sample_contexts(train_matrix, test_matrix, num_queries=1000):
+    """Up to num_queries random test users and their training items, used as request contexts"""
+    users = np.flatnonzero((np.diff(train_matrix.indptr) > 0) & (np.diff(test_matrix.indptr) > 0))
+    users = np.random.default_rng(0).permutation(users)[:num_queries]
+    return users, [train_matrix.indices[train_matrix.indptr[user]:train_matrix.indptr[user + 1]] for user in users]
 
-rating_matrix = load_rating_matrix_from_db(User, Interaction)
-num_users, num_items = rating_matrix.shape
+def time_requests(recommend, contexts):
+    """Results of recommend() for every context, and the mean latency per request in ms"""
+    start = time()
+    recommendations = [recommend(context) for context in contexts]
+    return recommendations, (time() - start) / max(len(contexts), 1) * 1000
 
-train_matrix, test_matrix = split_train_test(rating_matrix, test_ratio=args.test_ratio, shape=(num_users, num_items))
-model_cls = model_to_cls[args.model]
-model = model_cls()
+def evaluate_requests(recommend, users, contexts, test_matrix, ks):
+    """Ranking metrics of recommend() on the contexts of test users, and the latency per request"""
+    recommendations, latency_ms = time_requests(recommend, contexts)
+    # shorter lists are padded with -1
+    top_k = np.full((len(recommendations), max(ks)), -1, dtype=np.int64)
+    for row, items in enumerate(recommendations):
+        top_k[row, :len(items)] = items[:max(ks)]
+    evaluator = RankingEvaluator(test_matrix, ks)
+    evaluator.add(top_k, users)
+    return evaluator.result(), latency_ms
 
-print('Train start...')
-model.fit(train_matrix, save_path=args.save_dir)
+def benchmark_two_stage(model, candidate_model, users, contexts, test_matrix, k, nums_candidates):
+    """Print metrics at k and latency of reranking candidate_model's candidates next to full scoring"""
+    metrics = [f'{metric}@{k}' for metric in METRICS]
+    scores, latency_ms = evaluate_requests(lambda context: model.recommend(context, k), users, contexts, test_matrix, [k])
+    print(f"{'candidates':>10} " + ' '.join(f'{metric:>18}' for metric in metrics) + f" {'latency(ms)':>12}")
+    print(f"{'full':>10} " + ' '.join(f'{scores[metric]:>18.4f}' for metric in metrics) + f' {latency_ms:>12.3f}')
+    for num_candidates in nums_candidates:
+        two_stage_scores, two_stage_ms = evaluate_requests(
+            lambda context: rerank(model, candidate_model, context, k, num_candidates), users, contexts, test_matrix, [k])
+        print(f'{num_candidates:>10} '
+              + ' '.join(f'{two_stage_scores[metric]:>9.4f} ({two_stage_scores[metric] - scores[metric]:+.4f})' for metric in metrics)
+              + f' {two_stage_ms:>12.3f}')
 
-print('Train finished...')
+def benchmark_index(model, contexts, k, n_probes):
+    """Print recall@k of the model's index against exact search, and the latency per request"""
+    index, model.index = model.index, None
+    exact, exact_ms = time_requests(lambda context: model.recommend(context, k), contexts)
+    model.index = index
 
-prediction = model.predict(train_matrix)
-topk = extract_top_k(prediction, args.k)
+    print(f"{'n_probe':>10} {f'recall@{k}':>12} {'latency(ms)':>12}")
+    print(f"{'exact':>10} {1:>12.4f} {exact_ms:>12.3f}")
+    for n_probe in n_probes:
+        approximate, approximate_ms = time_requests(lambda context: model.recommend(context, k, n_probe=n_probe), contexts)
+        print(f'{n_probe:>10} {recall_at_k(approximate, exact):>12.4f} {approximate_ms:>12.3f}'
+              + (' *' if n_probe == model.n_probe else ''))
 
-# Evaluate
-scores = evaluate(topk, test_matrix, args.k)
+def main(args):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.app_context().push()
 
-model.save(args.save_dir)
\ No newline at end of file
+    db = SQLAlchemy()
+    db.init_app(app)
+
+    model_names = args.model.split(',')
+    try:
+        configs = parse_grid(args.params, model_names)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Incremental refresh: apply only the interactions created after the saved watermark
+    if args.incremental:
+        for model_name, params in configs:
+            model = model_to_cls[model_name](**params)
+            model.load_state(args.save_dir)
+            delta_matrix, watermark = load_interactions_since(Interaction, model.watermark)
+            if delta_matrix is None:
+                print(f'{model_name}: no interactions since {model.watermark}')
+                continue
+
+            stats = model.update(delta_matrix, check_drift=args.check_drift)
+            model.watermark = watermark
+            with CheckpointWriter(args.save_dir) as writer:
+                model.save(writer.staging_dir)
+                model.save_state(writer.staging_dir)
+            print(f'{model_name}: applied {delta_matrix.nnz} interactions up to {watermark}: '
+                  + ', '.join(f'{key}: {value}' for key, value in stats.items()))
+        return
+
+    if args.cache_dir is not None:
+        rating_matrix, watermark = RatingMatrixCache(args.cache_dir).load(User, Interaction)
+    else:
+        # read before loading so interactions written meanwhile are picked up by the next increment
+        watermark = latest_interaction_time(Interaction)
+        rating_matrix = load_rating_matrix_from_db(User, Interaction)
+    num_users, num_items = rating_matrix.shape
+
+    timestamps = load_interaction_timestamps(Interaction, rating_matrix) if args.split != 'random' else None
+    train_matrix, test_matrix = split_train_test(rating_matrix, test_ratio=args.test_ratio, shape=(num_users, num_items),
+                                                 mode=args.split, timestamps=timestamps, num_test=args.num_test,
+                                                 cutoff=args.cutoff, seed=args.seed)
+    eval_ks = sorted({args.k} | {int(k) for k in args.eval_ks.split(',') if k})
+    def evaluate_model(model):
+        return evaluate_streaming(model, train_matrix, test_matrix, eval_ks,
+                                  chunk_size=args.eval_chunk_size, n_threads=args.eval_threads)
+
+    # X^T X of the training split, shared by every model, configuration and reg built on it
+    gram = None
+    if any(getattr(model_to_cls[model_name], 'uses_gram', False) for model_name in model_names):
+        gram = load_gram(train_matrix, cache_dir=args.gram_cache_dir, n_jobs=args.gram_jobs)
+
+    # genres, year, age and gender for the models that use side features
+    features = None
+    if any(getattr(model_to_cls[model_name], 'uses_features', False) for model_name in model_names):
+        features = load_features(User, Movie, num_users, num_items)
+
+    split = Split(train_matrix, test_matrix, gram, features, eval_ks, args.eval_chunk_size, args.eval_threads)
+    regs = [parse_value(reg) for reg in args.reg_sweep.split(',')] if args.reg_sweep else None
+    selection_metric = f'{args.sweep_metric}@{args.k}'
+
+    print(f'Train start... ({len(configs)} configurations, {args.jobs} jobs)')
+    results = train_all(configs, split, jobs=args.jobs, cpus=args.cpus, regs=regs, sweep_metric=selection_metric)
+    print('Train finished...')
+
+    # Regularization sweeps: one factorization per configuration, every reg evaluated
+    for result in results:
+        if result.sweep_table is None:
+            continue
+        print(f'{result.model_name} reg sweep')
+        print(f"{'reg':>10} " + ' '.join(f'{metric:>12}' for metric in result.sweep_table[0][1]))
+        for reg, candidate_scores in result.sweep_table:
+            print(f'{reg:>10g} ' + ' '.join(f'{value:>12.4f}' for value in candidate_scores.values())
+                  + (' *' if reg == result.model.reg else ''))
+
+    # One comparison table over every trained configuration, best of each model marked
+    results = sorted(results, key=lambda result: result.scores[selection_metric], reverse=True)
+    best = {}
+    for result in results:
+        best.setdefault(result.model_name, result)
+    print(f"{'model':<10} {'params':<30} {'fit(s)':>8} " + ' '.join(f'{metric:>12}' for metric in results[0].scores))
+    for result in results:
+        print(f'{result.model_name:<10} {format_params(result.params):<30} {result.fit_time:>8.1f} '
+              + ' '.join(f'{value:>12.4f}' for value in result.scores.values())
+              + (' *' if best[result.model_name] is result else ''))
+
+    # every checkpoint is written to a staging directory and moved into save_dir at the end
+    users, contexts = sample_contexts(train_matrix, test_matrix)
+
+    # ItemKNN candidates for the two-stage comparison, the best one trained in this run or a default one
+    nums_candidates = [int(num) for num in args.rerank_candidates.split(',') if num]
+    candidate_model = None
+    if nums_candidates:
+        candidate_model = next((result.model for result in results if result.model_name == 'ItemKNN'), None)
+        if candidate_model is None:
+            candidate_model = model_to_cls['ItemKNN']()
+            candidate_model.fit(train_matrix, save_path=None, **({'gram': gram} if gram is not None else {}))
+
+    with CheckpointWriter(args.save_dir) as writer:
+        saved = []
+        # (label, model) of the saved models that also save incremental state
+        stateful = []
+        for result in results:
+            model, scores = result.model, result.scores
+            label = f'{result.model_name} ({format_params(result.params)})'
+
+            # Ranking metrics of each reduced precision next to full precision
+            if args.compare_precisions and hasattr(model, 'quantized'):
+                print(label)
+                print(f"{'precision':<10} {'weights(MB)':>12} " + ' '.join(f'{metric:>18}' for metric in scores))
+                print(f"{model.precision:<10} {weight_mb(model):>12.1f} " + ' '.join(f'{value:>18.4f}' for value in scores.values()))
+                for precision in args.compare_precisions.split(','):
+                    if precision not in model.precisions:
+                        print(f'{precision:<10} not supported by {result.model_name}')
+                        continue
+                    quantized_model = model.quantized(precision)
+                    quantized_scores = evaluate_model(quantized_model)
+                    print(f'{precision:<10} {weight_mb(quantized_model):>12.1f} '
+                          + ' '.join(f'{value:>9.4f} ({value - scores[metric]:+.4f})' for metric, value in quantized_scores.items()))
+
+            # Sparsified EASE, reported against the dense model
+            if args.prune_top_k is not None and hasattr(model, 'pruned'):
+                pruned_model = model.pruned(args.prune_top_k, args.prune_threshold)
+                pruned_scores = evaluate_model(pruned_model)
+                print(f'{label} pruned to {args.prune_top_k} weights per item, {weight_mb(pruned_model):.1f} MB (dense {weight_mb(model):.1f} MB)')
+                print(', '.join(f'{metric}: {value:.4f} ({value - scores[metric]:+.4f})' for metric, value in pruned_scores.items()))
+                if pruned_model.save_filename not in saved:
+                    pruned_model.save(writer.staging_dir)
+                    saved.append(pruned_model.save_filename)
+
+            if args.precision is not None and args.precision != model.precision and hasattr(model, 'quantized'):
+                if args.precision in model.precisions:
+                    model = model.quantized(args.precision)
+                else:
+                    print(f'{label}: {args.precision} not supported, saved in {model.precision}')
+
+            _, latency_ms = time_requests(lambda context: model.recommend(context, args.k), contexts)
+            print(f'{label}: {latency_ms:.3f}ms per request ({len(contexts)} test contexts, top {args.k})')
+            if candidate_model is not None and hasattr(model, 'score_candidates'):
+                print(f'{label} reranking ItemKNN candidates')
+                benchmark_two_stage(model, candidate_model, users, contexts, test_matrix, args.k, nums_candidates)
+
+            # configurations that share a checkpoint name keep the best one
+            if model.save_filename in saved:
+                print(f'{label}: {model.save_filename} already saved by a better configuration')
+                continue
+
+            # ANN index over the item factors, saved with the checkpoint
+            if args.ann_lists > 0 and hasattr(model, 'build_index'):
+                model.build_index(args.ann_lists)
+                print(f'{label}: IVF index with {model.index.num_lists} lists')
+                benchmark_index(model, contexts, args.k, [int(n_probe) for n_probe in args.ann_probes.split(',') if n_probe])
+
+            model.save(writer.staging_dir)
+            saved.append(model.save_filename)
+            if args.save_state and hasattr(model, 'build_state'):
+                stateful.append((label, model))
+
+        # Incremental state, once every model is benchmarked: the held-out test interactions are
+        # older than the watermark, so they are folded into the weights and the state here,
+        # a later delta would never bring them in
+        for label, model in stateful:
+            try:
+                model.build_state(train_matrix)
+            except ValueError as e:
+                print(f'{label}: incremental state not saved, {e}')
+                continue
+            stats = model.update(test_matrix)
+            print(f'{label}: added {test_matrix.nnz} test interactions to the saved model and state in {stats["seconds"]:.2f}s')
+            model.watermark = watermark
+            model.save(writer.staging_dir)
+            model.save_state(writer.staging_dir)
+    print(f"Saved {', '.join(saved)} to {args.save_dir}")
+
+if __name__ == '__main__':
+    main(parser.parse_args())
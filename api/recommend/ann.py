@@ -0,0 +1,138 @@
+"""
+Inverted file (IVF) index for maximum inner product search over item factors.
+
+Items are clustered with k-means; the coarse centroids split the catalog into
+lists, and every list's factors are stored contiguously. A query only scans the
+n_probe lists whose centroids have the largest inner product with it, so n_probe
+trades recall against latency (n_probe = num_lists is exact search).
+"""
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+# points assigned per step of k-means, bounds the (points, clusters) distances
+BLOCK_SIZE = 4096
+
+
+def _assign(vectors, centroids):
+    """Index of the nearest (L2) centroid of every vector"""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        # ||x||^2 is the same for every centroid and does not change the argmin
+        distances = centroid_norms - 2 * vectors[start:start + BLOCK_SIZE] @ centroids.T
+        labels[start:start + BLOCK_SIZE] = distances.argmin(axis=1)
+    return labels
+
+
+def kmeans(vectors, num_clusters, iterations=20, max_points_per_cluster=256, seed=0):
+    """
+    Lloyd's k-means, trained on a sample of at most max_points_per_cluster points per cluster
+
+    Returns:
+        (num_clusters, dim) centroids
+    """
+    rng = np.random.default_rng(seed)
+    num_clusters = min(num_clusters, len(vectors))
+    if len(vectors) > num_clusters * max_points_per_cluster:
+        vectors = vectors[rng.choice(len(vectors), num_clusters * max_points_per_cluster, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = _assign(vectors, centroids)
+        # per-cluster sums as one sparse (clusters, points) @ (points, dim) product
+        members = sp.csr_matrix((np.ones(len(vectors), dtype=vectors.dtype), (labels, np.arange(len(vectors)))),
+                                shape=(num_clusters, len(vectors)))
+        counts = np.bincount(labels, minlength=num_clusters)
+        nonempty = counts > 0
+        centroids[nonempty] = (members @ vectors)[nonempty] / counts[nonempty, np.newaxis]
+        # restart empty clusters from random points
+        num_empty = int((~nonempty).sum())
+        if num_empty > 0:
+            centroids[~nonempty] = vectors[rng.choice(len(vectors), num_empty, replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    IVF index over the rows of a (items, factors) matrix
+
+    centroids: (num_lists, factors) coarse centroids
+    offsets: list l holds positions offsets[l]:offsets[l + 1]
+    items: item id at every position, grouped by list
+    vectors: factors at every position, grouped by list
+    """
+    def __init__(self, centroids=None, offsets=None, items=None, vectors=None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.items = items
+        self.vectors = vectors
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, factors, num_lists=None, iterations=20, seed=0):
+        """Cluster the factors into num_lists lists (default: sqrt of the number of items)"""
+        factors = np.asarray(factors)
+        if num_lists is None:
+            num_lists = max(1, int(np.sqrt(len(factors))))
+        centroids = kmeans(factors, num_lists, iterations, seed=seed)
+        labels = _assign(factors, centroids)
+
+        items = np.argsort(labels, kind='stable')
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=len(centroids)), out=offsets[1:])
+        return cls(centroids.astype(factors.dtype), offsets, items, factors[items])
+
+    def search(self, query, top_k, n_probe=8, exclude=None):
+        """
+        Items with the largest inner product with query among the n_probe closest lists
+
+        Args:
+            query: (factors,) query vector
+            top_k: Number of items returned
+            n_probe: Lists scanned
+            exclude: Item ids never returned (e.g. the context)
+
+        Returns:
+            Item ids sorted by decreasing score, fewer than top_k when the probed lists run out
+        """
+        n_probe = min(n_probe, self.num_lists)
+        centroid_scores = self.centroids @ query
+        probes = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe] if n_probe < self.num_lists \
+            else np.arange(self.num_lists)
+
+        positions = np.concatenate([np.arange(self.offsets[probe], self.offsets[probe + 1]) for probe in probes])
+        candidates = self.items[positions]
+        if exclude is not None and len(exclude) > 0:
+            keep = ~np.isin(candidates, exclude)
+            positions, candidates = positions[keep], candidates[keep]
+        scores = self.vectors[positions] @ query
+
+        top_k = min(top_k, len(candidates))
+        if top_k == 0:
+            return candidates[:0]
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        return candidates[top[np.argsort(-scores[top])]]
+
+    def save(self, index_dir):
+        """Write the arrays as uncompressed .npy files so they can be memory mapped"""
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ('centroids', 'offsets', 'items', 'vectors'):
+            np.save(os.path.join(index_dir, f'{name}.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode=None):
+        arrays = {name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+                  for name in ('centroids', 'offsets', 'items', 'vectors')}
+        return cls(**arrays)
+
+
+def recall_at_k(approximate, exact):
+    """Mean fraction of every exact top-k list found in the approximate list of the same query"""
+    if len(exact) == 0:
+        return 0.0
+    return float(np.mean([len(np.intersect1d(a, e)) / max(len(e), 1) for a, e in zip(approximate, exact)]))
@@ -0,0 +1,171 @@
+"""
+On-disk snapshot of the rating matrix.
+
+The first load reads every interaction from the database and writes the csr
+arrays as a versioned raw directory next to a small meta.json. Later loads
+memory map that snapshot and only query the interactions created after its
+created_at high-water mark. The snapshot is rebuilt from scratch when the
+table schema changes or when rows it already covers were deleted or written
+without a created_at. Rows whose created_at moved past the watermark (updated
+interactions) come back in the next delta, and appending them again is a
+no-op, since the matrix is binary.
+"""
+import os
+import json
+import shutil
+import hashlib
+from datetime import datetime
+
+from sqlalchemy import func, or_
+
+from recommend.sparse import save_csr_raw, load_csr
+from recommend.utils import load_rating_matrix_from_db, latest_interaction_time, load_interactions_since
+
+# bump when the snapshot layout changes
+FORMAT_VERSION = 2
+
+
+def schema_hash(*tables):
+    """Hash of the column names and types of the given models"""
+    description = [FORMAT_VERSION]
+    for table in tables:
+        description.append([table.__tablename__] + [[column.name, str(column.type)] for column in table.__table__.columns])
+    return hashlib.sha1(json.dumps(description).encode()).hexdigest()
+
+
+def count_until(interactions, watermark):
+    """Number of interactions a matrix loaded up to `watermark` covers"""
+    query = interactions.query
+    if watermark is None:
+        return count_undated(interactions)
+    return query.filter(or_(interactions.created_at.is_(None), interactions.created_at <= watermark)).count()
+
+
+def count_undated(interactions):
+    """Number of interactions without a created_at, which no delta ever picks up"""
+    return interactions.query.filter(interactions.created_at.is_(None)).count()
+
+
+class RatingMatrixCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.meta_path = os.path.join(cache_dir, 'meta.json')
+
+    def load(self, users, interactions):
+        """
+        Current rating matrix, from the snapshot when it is still valid
+
+        Returns:
+            (csr rating matrix, created_at of the newest interaction it contains)
+        """
+        meta = self._read_meta()
+        reason = self._stale_reason(meta, users, interactions)
+        if reason is not None:
+            print(f'Rebuilding rating matrix snapshot: {reason}')
+            return self.rebuild(users, interactions)
+
+        watermark = datetime.fromisoformat(meta['watermark']) if meta['watermark'] else None
+        rating_matrix = load_csr(self._matrix_dir(meta['version']), mmap_mode='r')
+        delta_matrix, new_watermark = load_interactions_since(interactions, watermark)
+        num_interactions = count_until(interactions, new_watermark)
+        if delta_matrix is None:
+            if num_interactions < meta['num_interactions']:
+                print('Rebuilding rating matrix snapshot: interactions covered by the snapshot were deleted')
+                return self.rebuild(users, interactions)
+            print(f"Loaded rating matrix snapshot v{meta['version']} {rating_matrix.shape}")
+            return rating_matrix, watermark
+
+        num_users = max(rating_matrix.shape[0], delta_matrix.shape[0], self._num_user_rows(users))
+        num_items = max(rating_matrix.shape[1], delta_matrix.shape[1])
+        rating_matrix = rating_matrix.copy()
+        rating_matrix.resize(num_users, num_items)
+        delta_matrix.resize(num_users, num_items)
+
+        # every (user, item) the snapshot lacks needs at least one new row; delta entries it
+        # already holds may be updated rows that moved past the watermark, so fewer rows than
+        # that means some were deleted
+        num_new = delta_matrix.nnz - rating_matrix.multiply(delta_matrix).nnz
+        if num_interactions < meta['num_interactions'] + num_new:
+            print('Rebuilding rating matrix snapshot: interactions covered by the snapshot were deleted')
+            return self.rebuild(users, interactions)
+
+        rating_matrix = (rating_matrix + delta_matrix).tocsr()
+        rating_matrix.data[:] = 1
+
+        self._write(rating_matrix, new_watermark, meta['schema'], num_interactions,
+                    count_undated(interactions), meta['version'] + 1)
+        print(f"Appended {num_new} interactions to rating matrix snapshot v{meta['version'] + 1}"
+              f" ({delta_matrix.nnz - num_new} already in it)")
+        return rating_matrix, new_watermark
+
+    def rebuild(self, users, interactions):
+        """Load the whole matrix from the database and replace the snapshot"""
+        meta = self._read_meta()
+        version = meta['version'] + 1 if meta is not None else 1
+
+        # read before loading so interactions written meanwhile are appended next time
+        watermark = latest_interaction_time(interactions)
+        rating_matrix = load_rating_matrix_from_db(users, interactions)
+        self._write(rating_matrix, watermark, schema_hash(users, interactions),
+                    count_until(interactions, watermark), count_undated(interactions), version)
+        return rating_matrix, watermark
+
+    def _stale_reason(self, meta, users, interactions):
+        if meta is None:
+            return 'no snapshot'
+        if meta['schema'] != schema_hash(users, interactions):
+            return 'schema changed'
+        if self._num_user_rows(users) < meta['shape'][0]:
+            return 'user ids removed'
+        if count_undated(interactions) != meta['num_undated']:
+            return 'interactions without created_at changed'
+        return None
+
+    @staticmethod
+    def _num_user_rows(users):
+        max_user_id = users.query.with_entities(func.max(users.id)).scalar()
+        return max_user_id + 1 if max_user_id is not None else 0
+
+    def _matrix_dir(self, version):
+        return os.path.join(self.cache_dir, f'rating_matrix_v{version}')
+
+    def _read_meta(self):
+        if not os.path.exists(self.meta_path):
+            return None
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        if meta.get('format') != FORMAT_VERSION or not os.path.isdir(self._matrix_dir(meta['version'])):
+            return None
+        return meta
+
+    def _write(self, rating_matrix, watermark, schema, num_interactions, num_undated, version):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        matrix_dir = self._matrix_dir(version)
+        if os.path.isdir(matrix_dir):
+            shutil.rmtree(matrix_dir)
+        save_csr_raw(matrix_dir, rating_matrix)
+
+        meta = {
+            'format': FORMAT_VERSION,
+            'version': version,
+            'schema': schema,
+            'shape': list(rating_matrix.shape),
+            'nnz': int(rating_matrix.nnz),
+            # user and item ids are the row and column indices
+            'max_user_id': int(rating_matrix.shape[0] - 1),
+            'max_item_id': int(rating_matrix.shape[1] - 1),
+            # rows up to the watermark (undated ones included), a lower count means deletions
+            'num_interactions': num_interactions,
+            'num_undated': num_undated,
+            'watermark': watermark.isoformat() if watermark else None
+        }
+        # readers only ever see a complete snapshot: point meta.json at it last
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, self.meta_path)
+
+        # older versions may still be memory mapped, unlinking them is safe
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('rating_matrix_v') and name != os.path.basename(matrix_dir):
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
@@ -1,7 +1,14 @@
-import math
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
+import scipy.sparse as sp
 
 def extract_top_k(prediction, k):
+    # argpartition needs k < num_items; sort the whole row otherwise
+    if k >= prediction.shape[1]:
+        return np.argsort(-prediction, 1)
+
     # top_k item index (not sorted)
     relevant_items_partition = np.argpartition(-prediction, k, 1)[:, 0:k]
     
@@ -15,34 +22,161 @@ def extract_top_k(prediction, k):
 
     return topk
 
+METRICS = ['prec', 'recall', 'ndcg', 'map', 'hit_rate', 'coverage']
+
+class RankingEvaluator:
+    """
+    Accumulates ranking metrics at several cutoffs over batches of users
+
+    Hits of a whole batch are found at once by looking up the (user, item) keys
+    of the ranked lists in the sorted keys of the test matrix. Users without test
+    items are skipped; every metric except coverage is averaged over the rest.
+    """
+    def __init__(self, test_matrix, ks):
+        self.ks = sorted(set(ks))
+        self.num_items = test_matrix.shape[1]
+
+        test_matrix = sp.csr_matrix(test_matrix)
+        if not test_matrix.has_sorted_indices:
+            test_matrix = test_matrix.copy()
+            test_matrix.sort_indices()
+        self.indptr = test_matrix.indptr
+        self.num_targets = np.diff(test_matrix.indptr)
+        rows = np.repeat(np.arange(test_matrix.shape[0], dtype=np.int64), self.num_targets)
+        self.test_keys = rows * self.num_items + test_matrix.indices
+
+        # discount of rank i is 1 / log2(i + 2); ideal_dcg[n] is the best dcg with n test items
+        max_k = self.ks[-1]
+        self.discounts = 1 / np.log2(np.arange(2, max_k + 2))
+        self.ideal_dcg = np.concatenate([[1.0], np.cumsum(self.discounts)])
+
+        self.num_users = 0
+        self.sums = {f'{metric}@{k}': 0.0 for k in self.ks for metric in METRICS if metric != 'coverage'}
+        self.recommended = np.zeros((len(self.ks), self.num_items), dtype=bool)
+
+    def hits(self, top_k, users):
+        """Boolean (users, k) matrix, True where the ranked item is a test item of the user"""
+        keys = np.asarray(users, dtype=np.int64)[:, np.newaxis] * self.num_items + top_k
+        if len(self.test_keys) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        positions = np.minimum(np.searchsorted(self.test_keys, keys), len(self.test_keys) - 1)
+        return (self.test_keys[positions] == keys) & (top_k >= 0)
+
+    def add(self, top_k, users=None):
+        """
+        Args:
+            top_k: (users, >= max k) item ids, best first; negative ids pad lists shorter than k
+            users: Row of the test matrix of each ranked list (default: 0, 1, ...)
+        """
+        if users is None:
+            users = np.arange(len(top_k))
+        users = np.asarray(users)
+        num_targets = self.num_targets[users]
+        has_targets = num_targets > 0
+        top_k, users, num_targets = top_k[has_targets, :self.ks[-1]], users[has_targets], num_targets[has_targets]
+        if len(users) == 0:
+            return
+
+        hits = self.hits(top_k, users)
+        cum_hits = np.cumsum(hits, axis=1)
+        gains = np.cumsum(hits * self.discounts[:hits.shape[1]], axis=1)
+        # precision at every hit rank, summed up to k for average precision
+        cum_precisions = np.cumsum(hits * cum_hits / np.arange(1, hits.shape[1] + 1), axis=1)
+
+        for i, k in enumerate(self.ks):
+            last = min(k, hits.shape[1]) - 1
+            num_hits = cum_hits[:, last]
+            relevant = np.minimum(num_targets, k)
+            self.sums[f'prec@{k}'] += (num_hits / k).sum()
+            self.sums[f'recall@{k}'] += (num_hits / num_targets).sum()
+            self.sums[f'ndcg@{k}'] += (gains[:, last] / self.ideal_dcg[relevant]).sum()
+            self.sums[f'map@{k}'] += (cum_precisions[:, last] / relevant).sum()
+            self.sums[f'hit_rate@{k}'] += np.count_nonzero(num_hits)
+            ranked = top_k[:, :k].ravel()
+            self.recommended[i, ranked[ranked >= 0]] = True
+        self.num_users += len(users)
+
+    def merge(self, other):
+        self.num_users += other.num_users
+        for metric, value in other.sums.items():
+            self.sums[metric] += value
+        self.recommended |= other.recommended
+
+    def result(self):
+        score = {}
+        for i, k in enumerate(self.ks):
+            for metric in METRICS:
+                name = f'{metric}@{k}'
+                if metric == 'coverage':
+                    score[name] = np.count_nonzero(self.recommended[i]) / self.num_items
+                else:
+                    score[name] = self.sums[name] / self.num_users if self.num_users else 0.0
+        return score
+
+def _evaluate_shard(top_k, test_matrix, ks):
+    evaluator = RankingEvaluator(test_matrix, ks)
+    evaluator.add(top_k)
+    return evaluator
+
+def evaluate_ranking(top_k, test_matrix, ks, n_jobs=1):
+    """
+    Ranking metrics at every k in ks from one ranked list per user
+
+    Args:
+        top_k: (users, >= max(ks)) item ids, best first; row u is ranked for user u
+        test_matrix: (users, items) csr matrix of the held out interactions
+        ks: Cutoffs
+        n_jobs: Processes the users are sharded across (-1: one per cpu)
+
+    Returns:
+        {'prec@k', 'recall@k', 'ndcg@k', 'map@k', 'hit_rate@k', 'coverage@k'} for every k
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    evaluator = RankingEvaluator(test_matrix, ks)
+    if n_jobs <= 1:
+        evaluator.add(top_k)
+        return evaluator.result()
+
+    test_matrix = sp.csr_matrix(test_matrix)
+    shard_size = -(-len(top_k) // n_jobs)
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        shards = [executor.submit(_evaluate_shard, top_k[start:start + shard_size],
+                                  test_matrix[start:start + shard_size], ks)
+                  for start in range(0, len(top_k), shard_size)]
+        for shard in shards:
+            evaluator.merge(shard.result())
+    return evaluator.result()
+
+def evaluate_streaming(model, train_matrix, test_matrix, ks, chunk_size=1024, n_threads=1):
+    """
+    Score the users chunk by chunk, reduce every chunk to its top-k lists and
+    evaluate them, so at most n_threads dense (chunk_size, items) score blocks
+    exist at a time
+
+    Args:
+        model: Model with predict(rating_matrix), which masks seen items
+        train_matrix: (users, items) csr matrix the users are scored from
+        test_matrix: (users, items) csr matrix of the held out interactions
+        ks: Cutoffs
+        chunk_size: Users scored per predict call
+        n_threads: Chunks scored concurrently (BLAS and numpy release the GIL)
+
+    Returns:
+        Same metrics as evaluate_ranking
+    """
+    train_matrix = sp.csr_matrix(train_matrix)
+    evaluator = RankingEvaluator(test_matrix, ks)
+
+    def top_k_chunk(start):
+        prediction = model.predict(train_matrix[start:start + chunk_size])
+        return start, extract_top_k(prediction, evaluator.ks[-1])
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for start, top_k in executor.map(top_k_chunk, range(0, train_matrix.shape[0], chunk_size)):
+            evaluator.add(top_k, np.arange(start, start + len(top_k)))
+    return evaluator.result()
+
 def evaluate(top_k, test_matrix, k):
-    num_users = test_matrix.shape[0]
-    score = {
-        f'prec@{k}': 0.0,
-        f'recall@{k}': 0.0,
-        f'ndcg@{k}': 0.0
-    }
-    for u in range(num_users):
-        u_target = test_matrix.indices[test_matrix.indptr[u]: test_matrix.indptr[u+1]]
-        u_topk = top_k[u]
-        num_target = len(u_target)
-
-        hits_k = [(i + 1, item) for i, item in enumerate(u_topk) if item in u_target]
-        num_hits = len(hits_k)
-
-        idcg_k = 0.0
-        for i in range(1, min(num_target, k) + 1):
-            idcg_k += 1 / math.log(i + 1, 2)
-
-        dcg_k = 0.0
-        for idx, item in hits_k:
-            dcg_k += 1 / math.log(idx + 1, 2)
-        
-        prec_k = num_hits / k
-        recall_k = num_hits / num_target
-        ndcg_k = dcg_k / idcg_k
-
-        score[f'prec@{k}'] += prec_k / num_users
-        score[f'recall@{k}'] += recall_k / num_users
-        score[f'ndcg@{k}'] += ndcg_k / num_users
-    return score
\ No newline at end of file
+    score = evaluate_ranking(top_k, test_matrix, [k])
+    return {name: score[name] for name in (f'prec@{k}', f'recall@{k}', f'ndcg@{k}')}
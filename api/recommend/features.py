@@ -0,0 +1,84 @@
+"""
+Side features of users and movies, encoded as compact integer index arrays.
+
+Every field reserves index 0 for unknown values. Movies carry a year bucket
+and a bag of genres (csr rows), users an age bucket and a gender.
+"""
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse as sp
+
+# first year / age of every bucket after the unknown bucket 0
+YEAR_EDGES = [1901, 1950, 1970, 1980, 1990, 1994, 1996, 1997, 1998]
+AGE_EDGES = [0, 18, 25, 35, 45, 50, 56]
+GENDERS = ['-', 'Male', 'Female']
+
+Features = namedtuple('Features', ['item_years', 'item_genres', 'user_ages', 'user_genders', 'genre_names'])
+
+
+def bucketize(values, edges):
+    """Bucket index of every value: 0 below edges[0] (unknown), i + 1 from edges[i] on"""
+    return np.searchsorted(edges, values, side='right').astype(np.int8)
+
+
+def encode_genders(genders):
+    index = {gender: i for i, gender in enumerate(GENDERS)}
+    return np.array([index.get(gender, 0) for gender in genders], dtype=np.int8)
+
+
+def encode_genres(genres, genre_names=None):
+    """
+    Binary (items, genres + 1) csr matrix of comma separated genre strings,
+    column 0 marks items without a genre
+
+    Returns:
+        (matrix, genre_names) with genre_names[i] the genre of column i + 1
+    """
+    bags = [[name.strip() for name in (genre or '').split(',') if name.strip()] for genre in genres]
+    if genre_names is None:
+        genre_names = sorted({name for bag in bags for name in bag})
+    index = {name: i + 1 for i, name in enumerate(genre_names)}
+
+    columns = [[index[name] for name in bag if name in index] or [0] for bag in bags]
+    indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+    np.cumsum([len(column) for column in columns], out=indptr[1:])
+    indices = np.fromiter((i for column in columns for i in column), dtype=np.int32, count=indptr[-1])
+    matrix = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                           shape=(len(columns), len(genre_names) + 1))
+    return matrix, genre_names
+
+
+def load_features(users, movies, num_users, num_items):
+    """
+    Features of the first num_users users and num_items movies, ids without a row are unknown
+
+    Args:
+        users: User model
+        movies: Movie model
+    """
+    years = np.zeros(num_items, dtype=np.int64)
+    genres = [None] * num_items
+    for movie_id, genre, date in movies.query.with_entities(movies.id, movies.genre, movies.date):
+        if movie_id < num_items:
+            genres[movie_id] = genre
+            years[movie_id] = date.year if date is not None else 0
+    item_genres, genre_names = encode_genres(genres)
+
+    ages = np.full(num_users, -1, dtype=np.int64)
+    genders = ['-'] * num_users
+    for user_id, age, gender in users.query.with_entities(users.id, users.age, users.gender):
+        if user_id < num_users:
+            ages[user_id] = age if age is not None else -1
+            genders[user_id] = gender
+
+    return Features(bucketize(years, YEAR_EDGES), item_genres,
+                    bucketize(ages, AGE_EDGES), encode_genders(genders), genre_names)
+
+
+def unknown_features(num_users, num_items):
+    """Features with every value unknown, for training without the database tables"""
+    item_genres = sp.csr_matrix((np.ones(num_items, dtype=np.float32), np.zeros(num_items, dtype=np.int32),
+                                 np.arange(num_items + 1)), shape=(num_items, 1))
+    return Features(np.zeros(num_items, dtype=np.int8), item_genres,
+                    np.zeros(num_users, dtype=np.int8), np.zeros(num_users, dtype=np.int8), [])
@@ -0,0 +1,94 @@
+"""
+Item x item Gram matrix G = X^T X of a training matrix, shared by the models
+that start from it (EASE inverts G + reg * I, ItemKNN normalizes it to cosine
+similarity). Computed once per training matrix, in column blocks, and cached
+on disk under a hash of the matrix.
+"""
+import os
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+from recommend.sparse import save_csr_raw, load_csr
+
+_worker_matrix = None
+
+
+def _init_worker(train_matrix):
+    global _worker_matrix
+    _worker_matrix = train_matrix
+
+
+def _gram_block(block, train_matrix=None):
+    if train_matrix is None:
+        train_matrix = _worker_matrix
+    start, end = block
+    return (train_matrix.T @ train_matrix[:, start:end]).tocsc()
+
+
+def dataset_hash(train_matrix):
+    """Hash of the shape and csr arrays of a matrix"""
+    train_matrix = sp.csr_matrix(train_matrix)
+    digest = hashlib.sha1(str(train_matrix.shape).encode())
+    for array in (train_matrix.indptr, train_matrix.indices, train_matrix.data):
+        digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+
+def compute_gram(train_matrix, block_size=1000, n_jobs=1):
+    """
+    G = train_matrix^T @ train_matrix as a csr matrix, one block of columns at a time
+
+    Args:
+        train_matrix: (users, items) sparse matrix
+        block_size: Items per column block
+        n_jobs: Processes the blocks are spread over
+    """
+    train_matrix = sp.csc_matrix(train_matrix)
+    num_items = train_matrix.shape[1]
+    blocks = [(start, min(start + block_size, num_items)) for start in range(0, num_items, block_size)]
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(train_matrix,)) as pool:
+            pieces = list(pool.map(_gram_block, blocks))
+    else:
+        pieces = [_gram_block(block, train_matrix) for block in blocks]
+
+    if len(pieces) == 0:
+        return sp.csr_matrix((num_items, num_items), dtype=train_matrix.dtype)
+    return sp.hstack(pieces, format='csr')
+
+
+def load_gram(train_matrix, cache_dir=None, block_size=1000, n_jobs=1):
+    """
+    Gram matrix of train_matrix, read (memory mapped) from cache_dir when it was
+    computed for the same matrix before, otherwise computed and written there,
+    replacing the caches of other matrices
+    """
+    if cache_dir is None:
+        return compute_gram(train_matrix, block_size, n_jobs)
+
+    gram_dir = os.path.join(cache_dir, f'gram_{dataset_hash(train_matrix)[:16]}')
+    if os.path.isdir(gram_dir):
+        print(f'Loaded Gram matrix from {gram_dir}')
+        return load_csr(gram_dir, mmap_mode='r')
+
+    gram = compute_gram(train_matrix, block_size, n_jobs)
+    # write next to the final directory and rename, so readers never see a partial cache
+    tmp_dir = f'{gram_dir}.tmp{os.getpid()}'
+    save_csr_raw(tmp_dir, gram)
+    try:
+        os.rename(tmp_dir, gram_dir)
+    except OSError:
+        # another run cached the same matrix meanwhile
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # caches of earlier training splits are never read again; they may still be
+    # memory mapped, unlinking them is safe. Other runs' partial .tmp directories are left alone
+    for name in os.listdir(cache_dir):
+        if name.startswith('gram_') and '.tmp' not in name and name != os.path.basename(gram_dir):
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+    return gram
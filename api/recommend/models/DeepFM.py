@@ -1,51 +1,322 @@
 """
-Deep Factorization Machine Model (Placeholder)
-This is a placeholder for future deep learning implementation.
+DeepFM: A Factorization-Machine based Neural Network for CTR Prediction.
+Huifeng Guo, Ruiming Tang, Yunming Ye, Zhenguo Li, Xiuqiang He.
+IJCAI 2017.
 """
+import os
+from time import time
+
 import numpy as np
+import scipy.sparse as sp
+
+from recommend.features import AGE_EDGES, YEAR_EDGES, GENDERS, bucketize, encode_genders, unknown_features
+
+# fields of a (context, item) sample, the user side ones first
+USER_FIELDS = ['context', 'age', 'gender']
+ITEM_FIELDS = ['item', 'genre', 'year']
+DENSE_WEIGHTS = ['W1', 'b1', 'w2', 'bias']
+
+
+def _row_normalize(matrix):
+    """Scale every row of a csr matrix to sum to 1, so a product with a table mean pools its rows"""
+    row_sums = np.asarray(matrix.sum(axis=1)).ravel()
+    return sp.diags(1 / np.maximum(row_sums, 1)).dot(matrix).tocsr().astype(np.float32)
+
+
+def _scatter_rows(index, values, num_rows):
+    """Sum the rows of values into a (num_rows, dim) array at index"""
+    onehot = sp.csr_matrix((np.ones(len(index), dtype=values.dtype), (index, np.arange(len(index)))),
+                           shape=(num_rows, len(index)))
+    return onehot @ values
+
 
 class DeepFM:
     """
-    Deep Factorization Machine model placeholder.
-    In production, this would use PyTorch or TensorFlow to implement
-    a deep factorization machine for recommendation.
+    DeepFM over six fields: the context (bag of the user's items), age bucket and
+    gender of the user, and the id, genres (bag) and year bucket of the item. Bags
+    are mean pooled. Every table row holds the first order weight in column 0 and
+    the factors after it.
+
+    The FM and the first MLP layer are sums of a user side and an item side part,
+    so the item side is precomputed once (prepare()) and a request scores the whole
+    catalog with one (items, hidden) pass instead of a loop over items.
     """
-    
-    def __init__(self):
+    # features of users and items, passed to fit() (recommend.features)
+    uses_features = True
+
+    def __init__(self, factors=16, hidden=64, epochs=10, batch_size=1024, num_negatives=4,
+                 lr=5e-3, reg=1e-6, feature_dropout=0.5, seed=0):
+        self.factors = factors
+        self.hidden = hidden
+        self.epochs = epochs
+        self.batch_size = batch_size
+        # uniformly sampled negative items per observed interaction
+        self.num_negatives = num_negatives
+        self.lr = lr
+        self.reg = reg
+        # share of training samples whose age and gender are hidden, requests usually come without them
+        self.feature_dropout = feature_dropout
+        self.seed = seed
+        self.precision = 'float32'
+
         self.num_items = 0
         self.num_users = 0
-        self.model_loaded = False
-        
-    def restore(self, checkpoint_path):
-        """Restore model from checkpoint"""
-        # Placeholder - would load trained deep learning model
-        self.model_loaded = True
-        print(f"DeepFM model placeholder loaded from {checkpoint_path}")
-        
-    def recommend(self, user_item_ids, top_k=10):
+        self.weights = {}
+        self.item_years = None
+        self.genre_bags = None
+        # precomputed item side of the score
+        self.item_bias = None
+        self.item_sum = None
+        self.item_hidden = None
+
+    @property
+    def save_filename(self):
+        return f'DeepFM_{self.factors}'
+
+    def _init_weights(self, num_genres, rng):
+        vocab_sizes = {'context': self.num_items, 'age': len(AGE_EDGES) + 1, 'gender': len(GENDERS),
+                       'item': self.num_items, 'genre': num_genres, 'year': len(YEAR_EDGES) + 1}
+        weights = {field: (rng.standard_normal((size, self.factors + 1)) * 0.01).astype(np.float32)
+                   for field, size in vocab_sizes.items()}
+        num_inputs = len(vocab_sizes) * self.factors
+        weights['W1'] = (rng.standard_normal((num_inputs, self.hidden)) * np.sqrt(2 / num_inputs)).astype(np.float32)
+        weights['b1'] = np.zeros(self.hidden, dtype=np.float32)
+        weights['w2'] = (rng.standard_normal(self.hidden) * np.sqrt(1 / self.hidden)).astype(np.float32)
+        weights['bias'] = np.zeros(1, dtype=np.float32)
+        return weights
+
+    def _user_vectors(self, context_matrix, ages, genders):
+        """(rows, user fields, factors + 1) field vectors; context_matrix rows are mean pooling weights"""
+        return np.stack([context_matrix @ self.weights['context'], self.weights['age'][ages],
+                         self.weights['gender'][genders]], axis=1)
+
+    def _item_vectors(self, items, genre_bags):
+        return np.stack([self.weights['item'][items], genre_bags @ self.weights['genre'],
+                         self.weights['year'][self.item_years[items]]], axis=1)
+
+    def _forward(self, vectors):
+        """Logits of (batch, fields, factors + 1) field vectors, and what the backward pass needs"""
+        factors = vectors[:, :, 1:]
+        factor_sum = factors.sum(axis=1)
+        fm = 0.5 * ((factor_sum ** 2).sum(axis=1) - (factors ** 2).sum(axis=(1, 2)))
+
+        inputs = factors.reshape(len(vectors), -1)
+        pre_activation = inputs @ self.weights['W1'] + self.weights['b1']
+        activation = np.maximum(pre_activation, 0)
+        logits = self.weights['bias'] + vectors[:, :, 0].sum(axis=1) + fm + activation @ self.weights['w2']
+        return logits, (factors, factor_sum, inputs, pre_activation, activation)
+
+    def _backward(self, grad_logits, cache):
+        """Gradients of the dense weights and of the field vectors"""
+        factors, factor_sum, inputs, pre_activation, activation = cache
+        grad_pre_activation = np.outer(grad_logits, self.weights['w2'])
+        grad_pre_activation *= pre_activation > 0
+        grads = {'W1': inputs.T @ grad_pre_activation, 'b1': grad_pre_activation.sum(axis=0),
+                 'w2': activation.T @ grad_logits, 'bias': grad_logits.sum(keepdims=True)}
+
+        grad_vectors = np.empty((len(factors), factors.shape[1], self.factors + 1), dtype=np.float32)
+        grad_vectors[:, :, 0] = grad_logits[:, np.newaxis]
+        # d fm / d e_f = sum of the other fields' factors
+        grad_vectors[:, :, 1:] = grad_logits[:, np.newaxis, np.newaxis] * (factor_sum[:, np.newaxis] - factors)
+        grad_vectors[:, :, 1:] += (grad_pre_activation @ self.weights['W1'].T).reshape(factors.shape)
+        return grads, grad_vectors
+
+    def fit(self, train_matrix, save_path, features=None):
+        self.num_users, self.num_items = train_matrix.shape
+        if features is None:
+            features = unknown_features(self.num_users, self.num_items)
+        self.item_years = np.asarray(features.item_years)
+        self.genre_bags = _row_normalize(features.item_genres)
+        user_matrix = sp.csr_matrix(train_matrix, dtype=np.float32)
+        user_matrix.data[:] = 1
+        row_lengths = np.diff(user_matrix.indptr)
+
+        rng = np.random.default_rng(self.seed)
+        self.weights = self._init_weights(self.genre_bags.shape[1], rng)
+        moments = {name: (np.zeros_like(weight), np.zeros_like(weight)) for name, weight in self.weights.items()}
+
+        positive_users = np.repeat(np.arange(self.num_users), row_lengths)
+        positive_items = user_matrix.indices
+        samples_per_positive = 1 + self.num_negatives
+        positives_per_batch = max(self.batch_size // samples_per_positive, 1)
+
+        start = time()
+        step = 0
+        for _ in range(self.epochs):
+            order = rng.permutation(len(positive_items))
+            for batch_start in range(0, len(order), positives_per_batch):
+                batch = order[batch_start:batch_start + positives_per_batch]
+                users = np.repeat(positive_users[batch], samples_per_positive)
+                items = rng.integers(self.num_items, size=len(users))
+                items[::samples_per_positive] = positive_items[batch]
+                labels = np.zeros(len(users), dtype=np.float32)
+                labels[::samples_per_positive] = 1
+
+                # context of a positive sample is the rest of the user's items
+                contexts = user_matrix[users] - sp.csr_matrix((labels, (np.arange(len(users)), items)),
+                                                               shape=(len(users), self.num_items))
+                contexts = sp.diags(1 / np.maximum(row_lengths[users] - labels, 1)).dot(contexts).tocsr()
+                hidden_features = rng.random(len(users)) < self.feature_dropout
+                ages = np.where(hidden_features, 0, features.user_ages[users])
+                genders = np.where(hidden_features, 0, features.user_genders[users])
+                genre_bags = self.genre_bags[items]
+
+                vectors = np.concatenate([self._user_vectors(contexts, ages, genders),
+                                          self._item_vectors(items, genre_bags)], axis=1)
+                logits, cache = self._forward(vectors)
+                # mean binary cross entropy
+                grad_logits = (1 / (1 + np.exp(-logits)) - labels) / len(labels)
+                grads, grad_vectors = self._backward(grad_logits.astype(np.float32), cache)
+
+                grads['context'] = contexts.T @ grad_vectors[:, 0]
+                grads['age'] = _scatter_rows(ages, grad_vectors[:, 1], len(self.weights['age']))
+                grads['gender'] = _scatter_rows(genders, grad_vectors[:, 2], len(self.weights['gender']))
+                grads['item'] = _scatter_rows(items, grad_vectors[:, 3], self.num_items)
+                grads['genre'] = genre_bags.T @ grad_vectors[:, 4]
+                grads['year'] = _scatter_rows(self.item_years[items], grad_vectors[:, 5], len(self.weights['year']))
+
+                # Adam
+                step += 1
+                correction = np.sqrt(1 - 0.999 ** step) / (1 - 0.9 ** step)
+                for name, weight in self.weights.items():
+                    grad = np.asarray(grads[name], dtype=np.float32)
+                    if name not in DENSE_WEIGHTS:
+                        grad = grad + self.reg * weight
+                    first, second = moments[name]
+                    first *= 0.9
+                    first += 0.1 * grad
+                    second *= 0.999
+                    second += 0.001 * grad ** 2
+                    weight -= self.lr * correction * first / (np.sqrt(second) + 1e-8)
+
+        train_time = time() - start
+        num_samples = self.epochs * len(positive_items) * samples_per_positive
+        print(f'DeepFM trained {self.epochs} epochs on {num_samples} samples in {train_time:.2f}s '
+              f'({num_samples / max(train_time, 1e-9):.0f} samples/s)')
+        self.prepare()
+
+        # Save
+        if save_path is not None:
+            self.save(save_path)
+
+    def prepare(self):
+        """Precompute the item side of the FM and of the first MLP layer for every item"""
+        vectors = self._item_vectors(np.arange(self.num_items), self.genre_bags)
+        factors = vectors[:, :, 1:]
+        self.item_sum = factors.sum(axis=1)
+        self.item_bias = (self.weights['bias'] + vectors[:, :, 0].sum(axis=1)
+                          + 0.5 * ((self.item_sum ** 2).sum(axis=1) - (factors ** 2).sum(axis=(1, 2))))
+        num_user_inputs = len(USER_FIELDS) * self.factors
+        self.item_hidden = factors.reshape(self.num_items, -1) @ self.weights['W1'][num_user_inputs:] + self.weights['b1']
+
+    def _score_users(self, context_matrix, ages, genders, items=None):
+        """
+        (rows, items) logits of users given as mean pooling context rows and feature
+        indices, against every item or only the given items. The FM part is one matrix
+        product for all rows; the MLP runs one row at a time, so only one (items, hidden)
+        activation exists at once. Stacking rows into (rows, items, hidden) blocks was
+        slower, as the blocks no longer fit in cache.
+        """
+        item_sum, item_bias, item_hidden = self.item_sum, self.item_bias, self.item_hidden
+        if items is not None:
+            item_sum, item_bias, item_hidden = item_sum[items], item_bias[items], item_hidden[items]
+        user_sum, user_bias, user_hidden = self._user_side(context_matrix, ages, genders)
+
+        scores = user_sum @ item_sum.T
+        scores += user_bias[:, np.newaxis]
+        scores += item_bias
+        for row in range(len(user_sum)):
+            scores[row] += np.maximum(item_hidden + user_hidden[row], 0) @ self.weights['w2']
+        return scores
+
+    def _user_side(self, context_matrix, ages, genders):
+        """User side of the FM (factor sums, logit part) and of the first MLP layer, per row"""
+        vectors = self._user_vectors(context_matrix, ages, genders)
+        factors = vectors[:, :, 1:]
+        user_sum = factors.sum(axis=1)
+        user_bias = vectors[:, :, 0].sum(axis=1) + 0.5 * ((user_sum ** 2).sum(axis=1) - (factors ** 2).sum(axis=(1, 2)))
+        num_user_inputs = len(USER_FIELDS) * self.factors
+        user_hidden = factors.reshape(len(vectors), -1) @ self.weights['W1'][:num_user_inputs]
+        return user_sum, user_bias, user_hidden
+
+    def predict(self, rating_matrix, ages=None, genders=None):
+        """Scores of the users of a (users, items) matrix, feature indices default to unknown"""
+        num_rows = rating_matrix.shape[0]
+        context_matrix = sp.csr_matrix(rating_matrix, dtype=np.float32)
+        context_matrix.data[:] = 1
+        context_matrix = _row_normalize(context_matrix)
+        ages = np.zeros(num_rows, dtype=np.int8) if ages is None else ages
+        genders = np.zeros(num_rows, dtype=np.int8) if genders is None else genders
+
+        eval_output = self._score_users(context_matrix, ages, genders)
+        eval_output[context_matrix.nonzero()] = float('-inf')
+        return eval_output
+
+    def _request_inputs(self, user_context, age=None, gender=None):
+        """Mean pooling context row and feature indices of one request"""
+        if self.item_hidden is None:
+            raise ValueError("Model not loaded. Call restore() first.")
+        user_context = np.unique(user_context)
+        context_matrix = sp.csr_matrix((np.full(len(user_context), 1 / max(len(user_context), 1), dtype=np.float32),
+                                        user_context, [0, len(user_context)]), shape=(1, self.num_items))
+        age_index = bucketize([age if age is not None else -1], AGE_EDGES)
+        gender_index = encode_genders([gender if gender is not None else '-'])
+        return context_matrix, age_index, gender_index
+
+    def score(self, user_context, age=None, gender=None):
+        scores = self._score_users(*self._request_inputs(user_context, age, gender))[0]
+
+        scores[np.unique(user_context)] = float('-inf')
+        return scores
+
+    def score_into(self, user_context, out, age=None, gender=None):
+        """Write the scores of every item into out (float32, num_items), context items included"""
+        user_sum, user_bias, user_hidden = self._user_side(*self._request_inputs(user_context, age, gender))
+        np.dot(self.item_sum, user_sum[0], out=out)
+        out += self.item_bias
+        out += user_bias[0]
+        out += np.maximum(self.item_hidden + user_hidden[0], 0) @ self.weights['w2']
+        return out
+
+    def score_candidates(self, user_context, candidates, age=None, gender=None):
+        """Scores of the candidate items only"""
+        return self._score_users(*self._request_inputs(user_context, age, gender), items=candidates)[0]
+
+    def recommend(self, user_context, top_k=10, age=None, gender=None):
         """
         Generate recommendations for user based on their item history
-        
+
         Args:
-            user_item_ids: List of item IDs the user has interacted with
+            user_context: List of item IDs the user has interacted with
             top_k: Number of recommendations to return
-            
+            age: Age of the user, if known
+            gender: Gender of the user ('Male' or 'Female'), if known
+
         Returns:
             List of recommended item IDs
         """
-        if not self.model_loaded:
-            raise ValueError("Model not loaded. Call restore() first.")
-        
-        # Placeholder implementation
-        # In production, this would:
-        # 1. Extract features from user-item interactions
-        # 2. Pass through DeepFM network (wide & deep components)
-        # 3. Compute prediction scores for all items
-        # 4. Return top-k items
-        
-        print(f"DeepFM: Generating recommendations for user with {len(user_item_ids)} items")
-        print("Note: This is a placeholder. Deep learning implementation coming soon.")
-        
-        # Return empty list for now
-        return []
+        prediction = self.score(user_context, age, gender)
+        top_k = min(top_k, self.num_items)
 
+        relevant_items_partition = np.argpartition(-prediction, top_k - 1)[:top_k]
+        recommendation = relevant_items_partition[np.argsort(-prediction[relevant_items_partition])]
+        return recommendation.tolist()
+
+    def save(self, save_dir):
+        ckpt = os.path.join(save_dir, f'{self.save_filename}.npz')
+        genre_bags = sp.csr_matrix(self.genre_bags)
+        np.savez(ckpt, item_years=self.item_years, genre_data=genre_bags.data, genre_indices=genre_bags.indices,
+                 genre_indptr=genre_bags.indptr, **self.weights)
+
+    def restore(self, ckpt, mmap_mode=None):
+        """Restore model from checkpoint"""
+        with np.load(ckpt) as checkpoint:
+            self.weights = {name: checkpoint[name] for name in USER_FIELDS + ITEM_FIELDS + DENSE_WEIGHTS}
+            self.item_years = checkpoint['item_years']
+            self.num_items, factors = self.weights['item'].shape
+            self.genre_bags = sp.csr_matrix((checkpoint['genre_data'], checkpoint['genre_indices'],
+                                             checkpoint['genre_indptr']),
+                                            shape=(self.num_items, len(self.weights['genre'])))
+        self.factors = factors - 1
+        self.hidden = len(self.weights['b1'])
+        self.prepare()
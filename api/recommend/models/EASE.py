@@ -4,46 +4,354 @@ Harald Steck,
 Arxiv.
 """
 import os
+import json
 import math
+import tracemalloc
 from time import time
+from datetime import datetime
 
 import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import get_lapack_funcs, eigh
+
+from recommend.quantize import PRECISIONS, quantize_dense, gather_rows, matmul, accumulate_rows
+from recommend.sparse import top_k_per_column, save_csr, load_csr
+from recommend.utils import log_phase
 
 class EASE:
-    def __init__(self, reg=100):
+    # contexts covering more than this fraction of the catalog are scored with a dense GEMV
+    dense_context_ratio = 0.1
+    # fit() and sweep() accept a precomputed Gram matrix (recommend.gram)
+    uses_gram = True
+    # precisions quantized() accepts
+    precisions = PRECISIONS
+
+    def __init__(self, reg=100, precision=None, solver='inverse', solver_dtype='float32', max_update_rank=None):
         self.reg = reg
+        # 'inverse': float64 np.linalg.inv, 'cholesky': in-place LAPACK potrf/potri in solver_dtype
+        self.solver = solver
+        self.solver_dtype = solver_dtype
+        # storage precision, defaults to the dtype the solver produces, so save_filename
+        # (and load_state) only depend on the constructor arguments
+        if precision is None:
+            precision = solver_dtype if solver == 'cholesky' else 'float64'
+        self.precision = precision
         self.enc_w = None
+        # per-row scale of int8 weights
+        self.scale = None
+        # neighbours kept per item once enc_w is pruned to csr
+        self.pruned_top_k = None
+
+        # diag of P = (G + reg * I)^-1, which together with enc_w gives back P
+        self.inverse_diag = None
+        # incremental state: binary ratings and the created_at of the newest interaction they include
+        self.ratings = None
+        self.watermark = None
+        # updates of a higher rank than this (default num_items // 10) fall back to a full refit
+        self.max_update_rank = max_update_rank
     
     @property
     def save_filename(self):
-        return f'EASE_{self.reg}'
+        filename = f'EASE_{self.reg}'
+        if self.pruned_top_k is not None:
+            filename += f'_pruned{self.pruned_top_k}'
+        if self.precision != 'float64':
+            filename += f'_{self.precision}'
+        return filename
 
-    def fit(self, train_matrix, save_path):
+    @property
+    def reduced_precision(self):
+        # float16 and int8 weights are upcast block by block while scoring
+        return self.scale is not None or self.enc_w.dtype == np.float16
+
+    def fit(self, train_matrix, save_path, gram=None):
         self.num_users, self.num_items = train_matrix.shape    
         users = list(range(self.num_users))
 
-        G = train_matrix.T @ train_matrix
+        self.enc_w = self._solve(train_matrix, gram)
+
+        if self.precision != str(self.enc_w.dtype):
+            self.enc_w, self.scale = quantize_dense(self.enc_w, self.precision)
+
+        # Save
+        if save_path is not None:
+            self.save(save_path)
+
+    def _solve(self, train_matrix, gram=None):
+        """enc_w for train_matrix (or its Gram matrix) with the configured solver, also setting inverse_diag"""
+        if self.solver == 'cholesky':
+            return self._fit_cholesky(train_matrix, gram)
+
+        G = gram if gram is not None else train_matrix.T @ train_matrix
         diag = np.diag_indices(G.shape[0])
+        # the inverse solver works in float64 whatever the input dtype
+        G = G.astype(np.float64).toarray()
         G[diag] += self.reg
-        P = np.linalg.inv(G.toarray())
-        self.enc_w = P / (-np.diag(P))
-        self.enc_w[diag] = 0
+        P = np.linalg.inv(G)
+        self.inverse_diag = np.diag(P).copy()
+        enc_w = P / (-np.diag(P))
+        enc_w[diag] = 0
+        return enc_w
 
-        # Save
-        self.save(save_path)        
+    def _fit_cholesky(self, train_matrix, gram=None, block_size=1024):
+        """
+        enc_w from a Cholesky factorization of G + reg * I, computed in place in one
+        dense (items, items) buffer of solver_dtype; logs time and peak memory per phase.
+        """
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        try:
+            with log_phase('EASE gram'):
+                G = gram if gram is not None else train_matrix.T @ train_matrix
+                # symmetric, so the Fortran-ordered buffer LAPACK wants holds the same values
+                P = G.astype(self.solver_dtype).toarray(order='F')
+                del G
+                P.flat[::self.num_items + 1] += self.reg
+
+            with log_phase('EASE cholesky'):
+                potrf, potri = get_lapack_funcs(('potrf', 'potri'), (P,))
+                P, info = potrf(P, lower=False, overwrite_a=True, clean=False)
+                if info != 0:
+                    raise np.linalg.LinAlgError(f'potrf failed with info={info}, try a larger reg')
+
+            with log_phase('EASE inverse'):
+                P, info = potri(P, lower=False, overwrite_c=True)
+                if info != 0:
+                    raise np.linalg.LinAlgError(f'potri failed with info={info}')
+
+                # only the upper triangle (lower triangle of the C-ordered view) is valid,
+                # mirror it block by block to bound the temporaries
+                P = P.T
+                for start in range(0, self.num_items, block_size):
+                    end = min(start + block_size, self.num_items)
+                    block = P[start:end, start:end]
+                    P[start:end, start:end] = np.tril(block) + np.tril(block, -1).T
+                    P[start:end, end:] = P[end:, start:end].T
+
+            with log_phase('EASE scaling'):
+                self.inverse_diag = np.diag(P).copy()
+                P /= -self.inverse_diag
+                P.flat[::self.num_items + 1] = 0
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        return P
+
+    @classmethod
+    def sweep(cls, train_matrix, regs, dtype='float64', gram=None, **params):
+        """
+        Yield one fitted EASE per reg in regs from a single eigendecomposition
+        G = V diag(e) V^T, using (G + reg * I)^-1 = V diag(1 / (e + reg)) V^T.
+        params go to the constructor, every model is stored in params['precision'] when given.
+        """
+        num_items = train_matrix.shape[1]
+        with log_phase('EASE eigendecomposition'):
+            G = gram if gram is not None else train_matrix.T @ train_matrix
+            G = G.astype(dtype).toarray()
+            eigvals, eigvecs = eigh(G, overwrite_a=True, check_finite=False)
+            del G
+
+        for reg in regs:
+            with log_phase(f'EASE reg={reg}'):
+                inv_eigvals = 1 / (eigvals + reg)
+                P = (eigvecs * inv_eigvals) @ eigvecs.T
+                inverse_diag = np.diag(P).copy()
+                P /= -inverse_diag
+                P.flat[::num_items + 1] = 0
+
+            model = cls(reg, **params)
+            model.inverse_diag = inverse_diag
+            model.num_items = num_items
+            if model.precision == str(P.dtype):
+                model.enc_w = P
+            else:
+                model.enc_w, model.scale = quantize_dense(P, model.precision)
+            yield model
+
+    def build_state(self, train_matrix):
+        """Keep the ratings enc_w was fitted on, so update() can apply low-rank changes"""
+        if self.inverse_diag is None or self.scale is not None or sp.issparse(self.enc_w):
+            raise ValueError('Incremental updates need dense full precision weights from fit()')
+        self.ratings = sp.csr_matrix(train_matrix, dtype=np.float32)
+        self.ratings.data[:] = 1
+
+    def update(self, delta_matrix, check_drift=False):
+        """
+        Add new (user, item) interactions with a Woodbury update of P = (G + reg * I)^-1
+
+        The Gram matrix changes by new_rows^T new_rows - old_rows^T old_rows for the users
+        with new interactions, i.e. Z^T S Z with Z = [new_rows; old_rows], S = diag(1, -1), so
+        P' = P - P Z^T (S + Z P Z^T)^-1 Z P. A rank above max_update_rank falls back to a full refit.
+
+        Args:
+            delta_matrix: Sparse (users, items) matrix of interactions since the watermark
+            check_drift: Also refit from scratch and report the largest enc_w difference
+
+        Returns:
+            Dict with the number of affected users, the update rank, whether it refit,
+            the elapsed seconds and the drift against a full refit (None unless checked)
+        """
+        if self.ratings is None:
+            raise ValueError('No incremental state. Fit with build_state() or restore it with load_state() first.')
+        start = time()
+
+        num_users = max(self.ratings.shape[0], delta_matrix.shape[0])
+        delta_matrix = sp.csr_matrix(delta_matrix, dtype=np.float32)
+        if delta_matrix.shape[1] > self.num_items:
+            raise ValueError('New items change the size of enc_w, run a full fit instead')
+        delta_matrix.resize(num_users, self.num_items)
+        delta_matrix.data[:] = 1
+        self.ratings.resize(num_users, self.num_items)
+
+        affected_users = np.flatnonzero(np.diff(delta_matrix.indptr))
+        old_rows = self.ratings[affected_users]
+        new_rows = old_rows + delta_matrix[affected_users]
+        new_rows.data[:] = 1
+        self.ratings = self.ratings + delta_matrix
+        self.ratings.data[:] = 1
+
+        # users without earlier interactions only add a row
+        old_rows = old_rows[np.flatnonzero(np.diff(old_rows.indptr))]
+        Z = sp.vstack([new_rows, old_rows]).tocsr()
+        rank = Z.shape[0]
+        max_rank = self.max_update_rank if self.max_update_rank is not None else self.num_items // 10
+
+        if rank > max_rank:
+            self.enc_w = self._solve(self.ratings).astype(self.enc_w.dtype, copy=False)
+        else:
+            # P from enc_w: column j of enc_w is P[:, j] / -P[j, j]
+            P = self.enc_w * -self.inverse_diag
+            P.flat[::self.num_items + 1] = self.inverse_diag
+
+            S = np.concatenate([np.ones(new_rows.shape[0]), -np.ones(old_rows.shape[0])])
+            ZP = np.asarray(Z @ P)
+            K = np.diag(S) + np.asarray(Z @ ZP.T)
+            P -= ZP.T @ np.linalg.solve(K, ZP)
+
+            self.inverse_diag = np.diag(P).copy()
+            P /= -self.inverse_diag
+            P.flat[::self.num_items + 1] = 0
+            self.enc_w = P.astype(self.enc_w.dtype, copy=False)
+
+        stats = {
+            'users': len(affected_users),
+            'rank': rank,
+            'refit': rank > max_rank,
+            'seconds': time() - start,
+            'drift': None
+        }
+        if check_drift:
+            reference = EASE(self.reg, self.precision, self.solver, self.solver_dtype)
+            reference.num_items = self.num_items
+            stats['drift'] = float(np.abs(reference._solve(self.ratings) - self.enc_w).max())
+        return stats
+
+    def save_state(self, save_dir):
+        sp.save_npz(os.path.join(save_dir, f'{self.save_filename}_ratings'), self.ratings)
+        np.save(os.path.join(save_dir, f'{self.save_filename}_inverse_diag'), self.inverse_diag)
+        with open(os.path.join(save_dir, f'{self.save_filename}_state.json'), 'w') as f:
+            json.dump({'watermark': self.watermark.isoformat() if self.watermark else None}, f)
+
+    def load_state(self, save_dir):
+        """Restore the checkpoint in save_dir together with its incremental state"""
+        self.restore(os.path.join(save_dir, f'{self.save_filename}.npy'))
+        self.ratings = sp.load_npz(os.path.join(save_dir, f'{self.save_filename}_ratings.npz'))
+        self.inverse_diag = np.load(os.path.join(save_dir, f'{self.save_filename}_inverse_diag.npy'))
+        with open(os.path.join(save_dir, f'{self.save_filename}_state.json')) as f:
+            watermark = json.load(f)['watermark']
+        self.watermark = datetime.fromisoformat(watermark) if watermark else None
+
+    def quantized(self, precision):
+        """Copy of this model with enc_w stored in the given precision"""
+        if self.scale is not None:
+            raise ValueError('Cannot requantize int8 weights')
+        if sp.issparse(self.enc_w):
+            raise ValueError('Cannot quantize pruned weights')
+        model = EASE(self.reg, precision, self.solver, self.solver_dtype, self.max_update_rank)
+        model.enc_w, model.scale = quantize_dense(self.enc_w, precision)
+        model.num_items = self.num_items
+        # float copies keep the incremental state, int8 ones cannot be updated
+        if model.scale is None:
+            model.inverse_diag = self.inverse_diag
+        return model
+
+    def pruned(self, top_k=200, threshold=None, block_size=500):
+        """
+        Copy of this model keeping only the top_k largest-magnitude weights of every
+        column of enc_w (and, with threshold, only those with |w| >= threshold).
+        The pruned enc_w is a csr matrix scored through the sparse path ItemKNN uses.
+        """
+        if self.scale is not None or sp.issparse(self.enc_w):
+            raise ValueError('Only dense full precision weights can be pruned')
+
+        values, rows, cols = [], [], []
+        for start_col in range(0, self.num_items, block_size):
+            block = np.asarray(self.enc_w[:, start_col:start_col + block_size])
+            if threshold is not None:
+                block = np.where(np.abs(block) >= threshold, block, 0)
+            block_rows, block_cols, block_values = top_k_per_column(block, top_k, start_col, by_magnitude=True)
+            rows.append(block_rows)
+            cols.append(block_cols)
+            values.append(block_values)
+
+        model = EASE(self.reg, self.precision)
+        model.enc_w = sp.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                    shape=(self.num_items, self.num_items))
+        model.num_items = self.num_items
+        model.pruned_top_k = top_k
+        return model
 
     def predict(self, rating_matrix):
         input_matrix = rating_matrix
-        eval_output = input_matrix @ self.enc_w
+        if self.reduced_precision:
+            eval_output = matmul(input_matrix, self.enc_w, self.scale)
+        else:
+            eval_output = input_matrix @ self.enc_w
+        if not isinstance(eval_output, np.ndarray):
+            eval_output = eval_output.toarray()
         eval_output[rating_matrix.nonzero()] = float('-inf')
 
         return eval_output
     
-    def recommend(self, user_context, top_k=10):
-        user_vec = np.zeros((1, self.num_items))
-        user_vec[0, user_context] = 1
+    def score(self, user_context):
+        user_context = np.unique(user_context)
+
+        if sp.issparse(self.enc_w):
+            scores = np.asarray(self.enc_w[user_context].sum(axis=0)).ravel()
+        elif self.reduced_precision or len(user_context) <= self.dense_context_ratio * self.num_items:
+            # binary user vector: user_vec @ enc_w is the sum of the context rows, added
+            # one at a time (upcast to float32 when reduced), never a (context, items) block
+            dtype = np.float32 if self.reduced_precision else self.enc_w.dtype
+            scores = accumulate_rows(self.enc_w, self.scale, user_context, np.zeros(self.num_items, dtype=dtype))
+        else:
+            # in enc_w's dtype, so the GEMV does not upcast the whole matrix
+            user_vec = np.zeros((1, self.num_items), dtype=self.enc_w.dtype)
+            user_vec[0, user_context] = 1
+            scores = (user_vec @ self.enc_w)[0]
+
+        scores[user_context] = float('-inf')
+        return scores
 
-        prediction = self.predict(user_vec)
+    def score_into(self, user_context, out):
+        """Write the scores of every item into out (float32, num_items), context items included"""
+        out[:] = 0
+        return accumulate_rows(self.enc_w, self.scale, np.unique(user_context), out)
+
+    def score_candidates(self, user_context, candidates):
+        """Scores of the candidate items only, reading the (context, candidates) block of enc_w"""
+        user_context = np.unique(user_context)
+
+        if sp.issparse(self.enc_w):
+            block = gather_rows(self.enc_w, self.scale, user_context)[:, candidates]
+            return np.asarray(block.sum(axis=0)).ravel()
+        block = self.enc_w[np.ix_(user_context, candidates)].astype(np.float32)
+        if self.scale is not None:
+            block *= self.scale[user_context, np.newaxis]
+        return block.sum(axis=0)
+
+    def recommend(self, user_context, top_k=10):
+        prediction = self.score(user_context)[np.newaxis]
 
         relevant_items_partition = (-prediction).argpartition(top_k, 1)[:, 0:top_k]
     
@@ -59,8 +367,27 @@ class EASE:
         return recommendation.reshape(-1).tolist()
 
     def save(self, save_dir):
+        if sp.issparse(self.enc_w):
+            save_csr(save_dir, self.save_filename, self.enc_w)
+            return
         np.save(os.path.join(save_dir, self.save_filename), self.enc_w)
+        if self.scale is not None:
+            np.save(os.path.join(save_dir, f'{self.save_filename}_scale'), self.scale)
+
+    def restore(self, ckpt, mmap_mode=None):
+        # .npy keeps enc_w as one aligned raw buffer, so mmap_mode='r' maps it
+        # without copying and worker processes share the page cache
+        if ckpt.endswith('.npz'):
+            # pruned checkpoint
+            self.enc_w = load_csr(ckpt, mmap_mode=mmap_mode)
+            self.pruned_top_k = int(np.bincount(self.enc_w.indices, minlength=1).max())
+        else:
+            self.enc_w = np.load(ckpt, mmap_mode=mmap_mode)
+        self.num_items = self.enc_w.shape[0]
 
-    def restore(self, ckpt):
-        self.enc_w = np.load(ckpt)
-        self.num_items = self.enc_w.shape[0]
\ No newline at end of file
+        scale_ckpt = f'{os.path.splitext(ckpt)[0]}_scale.npy'
+        if os.path.exists(scale_ckpt):
+            self.scale = np.load(scale_ckpt)
+            self.precision = 'int8'
+        else:
+            self.precision = str(self.enc_w.dtype)
\ No newline at end of file
@@ -1,108 +1,358 @@
 import os
+import json
 import math
+from datetime import datetime
 from time import time
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 import numpy as np
 import scipy.sparse as sp
 
+from recommend.quantize import SPARSE_PRECISIONS, quantize_csr, matmul, accumulate_rows
+from recommend.sparse import top_k_per_column, top_k_per_sparse_column, save_csr, load_csr
+
+def _similarity_block(train_matrix, norms, top_k, shrink, similarity, density_threshold,
+                      start_col_block, end_col_block):
+    """Top-k cosine neighbours of the items in [start_col_block, end_col_block) as (rows, cols, values)"""
+    num_users = train_matrix.shape[0]
+
+    # All data points for a given item
+    # item_data: user, item blocks
+    item_data = train_matrix[:, start_col_block:end_col_block]
+    density = item_data.nnz / max(num_users * (end_col_block - start_col_block), 1)
+
+    # Compute item similarities
+    # (item, user) x (user, item blocks) = (item, item blocks)
+    if similarity == 'dense' or (similarity == 'auto' and density >= density_threshold):
+        block_weights = train_matrix.T.dot(item_data.toarray())
+        return _top_k_cosine(block_weights, norms, np.arange(start_col_block, end_col_block), top_k, shrink)
+
+    # sparse x sparse co-occurrence counts, memory scales with the non-zeros
+    block_weights = train_matrix.T @ item_data
+    return _top_k_cosine_sparse(block_weights, norms, np.arange(start_col_block, end_col_block), top_k, shrink)
+
+def _gram_similarity_block(gram, norms, top_k, shrink, similarity, density_threshold,
+                           start_col_block, end_col_block):
+    """Same as _similarity_block, reading the co-occurrence counts from a precomputed symmetric Gram matrix"""
+    # symmetric, so the transposed rows of the block are its (item, item block) columns
+    block_weights = gram[start_col_block:end_col_block].T
+    density = block_weights.nnz / max(block_weights.shape[0] * block_weights.shape[1], 1)
+    block_items = np.arange(start_col_block, end_col_block)
+
+    if similarity == 'dense' or (similarity == 'auto' and density >= density_threshold):
+        return _top_k_cosine(block_weights.toarray(), norms, block_items, top_k, shrink)
+    return _top_k_cosine_sparse(block_weights, norms, block_items, top_k, shrink)
+
+def _top_k_cosine(block_weights, norms, block_items, top_k, shrink):
+    """Normalize (item, block) co-occurrence counts to cosine similarity and keep the top-k per column"""
+    block_weights = np.asarray(block_weights, dtype=np.float64)
+
+    # zero out self similarity
+    block_weights[block_items, np.arange(len(block_items))] = 0.0
+
+    # cosine similarity
+    # denominator = sqrt(l2_norm(x)) * sqrt(l2_norm(y)) + shrinkage, items without interactions get 0
+    denominator = np.outer(norms, norms[block_items])
+    denominator += shrink
+    np.divide(block_weights, denominator, out=block_weights, where=denominator != 0)
+
+    rows, cols, values = top_k_per_column(block_weights, top_k)
+    return rows, block_items[cols], values
+
+def _top_k_cosine_sparse(block_weights, norms, block_items, top_k, shrink):
+    """_top_k_cosine on a sparse (item, block) matrix, normalizing and selecting only its stored entries"""
+    block_weights = sp.csc_matrix(block_weights, dtype=np.float32)
+    rows = block_weights.indices
+    items = block_items[np.repeat(np.arange(len(block_items)), np.diff(block_weights.indptr))]
+
+    # zero out self similarity
+    block_weights.data[rows == items] = 0.0
+
+    denominator = norms[rows] * norms[items]
+    denominator += shrink
+    np.divide(block_weights.data, denominator, out=block_weights.data, where=denominator != 0)
+
+    rows, cols, values = top_k_per_sparse_column(block_weights, top_k)
+    return rows, block_items[cols], values
+
+def _sorted_columns(W_sparse):
+    """Values of W_sparse ordered by column, then by value"""
+    W_csc = sp.csc_matrix(W_sparse)
+    columns = np.repeat(np.arange(W_csc.shape[1]), np.diff(W_csc.indptr))
+    return W_csc.data[np.lexsort((W_csc.data, columns))]
+
+_worker_function = None
+_worker_args = None
+
+def _init_block_worker(function, *args):
+    global _worker_function, _worker_args
+    _worker_function = function
+    _worker_args = args
+
+def _block_worker(block):
+    return _worker_function(*_worker_args, *block)
+
 class ItemKNN:
-    def __init__(self, top_k=100):
+    # fit() accepts a precomputed Gram matrix (recommend.gram)
+    uses_gram = True
+    # precisions quantized() accepts
+    precisions = SPARSE_PRECISIONS
+    # candidates() sums neighbourhoods in a dense buffer once they hold this fraction of the catalog
+    dense_candidate_ratio = 0.05
+
+    def __init__(self, top_k=100, precision='float32', block_size=500, n_jobs=1,
+                 shrink=0, similarity='auto', density_threshold=0.05):
         self.top_k = top_k
+        self.precision = precision
+        # shrinkage added to the cosine denominator
+        self.shrink = shrink
+        # 'dense' densifies each (users, block) slice, 'sparse' multiplies sparse x sparse,
+        # 'auto' picks per block: dense when the block's density is at least density_threshold
+        self.similarity = similarity
+        self.density_threshold = density_threshold
+        # items per similarity block, and processes the blocks are spread over
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        # per-row scale of int8 weights
+        self.scale = None
+
+        # incremental state: binary ratings, item co-occurrence counts and the
+        # created_at of the newest interaction they include
+        self.ratings = None
+        self.cooccurrence = None
+        self.watermark = None
 
     @property
     def save_filename(self):
-        return f'ItemKNN_{self.top_k}'
+        if self.precision == 'float32':
+            return f'ItemKNN_{self.top_k}'
+        return f'ItemKNN_{self.top_k}_{self.precision}'
 
-    def fit(self, train_matrix, save_path):
+    def fit(self, train_matrix, save_path, gram=None):
         num_users, num_items = train_matrix.shape   
+        self.num_items = num_items
         train_matrix = train_matrix.tocsc()
 
-        start_col_local = 0
-        end_col_local = num_items
+        start = time()
 
-        start_col_block = start_col_local
+        blocks = [(start_col_block, min(start_col_block + self.block_size, num_items))
+                  for start_col_block in range(0, num_items, self.block_size)]
 
-        this_block_size = 0
-        block_size = 500
+        if gram is not None:
+            # the diagonal of X^T X holds the squared norms
+            sumOfSquared = np.sqrt(gram.diagonal())
+            block_args = (_gram_similarity_block, sp.csr_matrix(gram), sumOfSquared, self.top_k, self.shrink,
+                          self.similarity, self.density_threshold)
+        else:
+            sumOfSquared = np.array(train_matrix.power(2).sum(axis=0)).ravel()
+            sumOfSquared = np.sqrt(sumOfSquared)
+            block_args = (_similarity_block, train_matrix, sumOfSquared, self.top_k, self.shrink,
+                          self.similarity, self.density_threshold)
 
-        
-        start = time()
+        if self.n_jobs > 1:
+            # each worker receives the training matrix once and returns partial csr pieces
+            with ProcessPoolExecutor(self.n_jobs, initializer=_init_block_worker, initargs=block_args) as pool:
+                pieces = pool.map(_block_worker, blocks)
+                rows, cols, values = self._collect_pieces(pieces, num_items, num_items)
+        else:
+            pieces = (block_args[0](*block_args[1:], *block) for block in blocks)
+            rows, cols, values = self._collect_pieces(pieces, num_items, num_items)
+
+        print(f'ItemKNN similarity computed in {time() - start:.2f}s')
 
-        sumOfSquared = np.array(train_matrix.power(2).sum(axis=0)).ravel()
-        sumOfSquared = np.sqrt(sumOfSquared)
-
-        values = []
-        rows = []
-        cols = []
-        while start_col_block < end_col_local:
-            end_col_block = min(start_col_block + block_size, end_col_local)
-            this_block_size = end_col_block-start_col_block
-
-            # All data points for a given item
-            # item_data: user, item blocks
-            item_data = train_matrix[:, start_col_block:end_col_block]
-            item_data = item_data.toarray().squeeze()
-
-            # If only 1 feature avoid last dimension to disappear
-            if item_data.ndim == 1:
-                item_data = np.atleast_2d(item_data)
-
-            # if self.use_row_weights:
-            #     this_block_weights = self.dataMatrix_weighted.T.dot(item_data)
-
-            # else:
-            #     # Compute item similarities
-            #     # (item, user) x (user, item blocks) = (item, item blocks)
-            this_block_weights = train_matrix.T.dot(item_data)
-
-            for col_index_in_block in range(this_block_size):
-                # this_block_size: (item,)
-                # similarity between 'one block item' and whole items
-                if this_block_size == 1:
-                    this_column_weights = this_block_weights
-                else:
-                    this_column_weights = this_block_weights[:,col_index_in_block]
-
-                # columnIndex = item index
-                # zero out self similarity
-                columnIndex = col_index_in_block + start_col_block
-                this_column_weights[columnIndex] = 0.0
-
-                # cosine similarity
-                # denominator = sqrt(l2_norm(x)) * sqrt(l2_norm(y))+ shrinkage + eps
-                denominator = sumOfSquared[columnIndex] * sumOfSquared
-                this_column_weights = np.multiply(this_column_weights, 1 / denominator)
-
-                relevant_items_partition = (-this_column_weights).argpartition(self.top_k-1)[0:self.top_k]
-                relevant_items_partition_sorting = np.argsort(-this_column_weights[relevant_items_partition])
-                top_k_idx = relevant_items_partition[relevant_items_partition_sorting]
-
-                # Incrementally build sparse matrix, do not add zeros
-                notZerosMask = this_column_weights[top_k_idx] != 0.0
-                numNotZeros = np.sum(notZerosMask)
-
-                values.extend(this_column_weights[top_k_idx][notZerosMask])
-                rows.extend(top_k_idx[notZerosMask])
-                cols.extend(np.ones(numNotZeros) * columnIndex)
-
-            start_col_block += block_size
-        
         self.W_sparse = sp.csr_matrix((values, (rows, cols)),
                             shape=(num_items, num_items),
                             dtype=np.float32)
+        if self.precision != 'float32':
+            self.W_sparse, self.scale = quantize_csr(self.W_sparse, self.precision)
+
         # Save
-        self.save(save_path)
+        if save_path is not None:
+            self.save(save_path)
+
+    def _collect_pieces(self, pieces, num_columns, num_items):
+        # every column keeps at most top_k neighbours, so the output size is known upfront
+        capacity = num_columns * min(self.top_k, num_items)
+        rows = np.empty(capacity, dtype=np.int32)
+        cols = np.empty(capacity, dtype=np.int32)
+        values = np.empty(capacity, dtype=np.float32)
+
+        num_values = 0
+        for piece_rows, piece_cols, piece_values in pieces:
+            end = num_values + len(piece_values)
+            rows[num_values:end] = piece_rows
+            cols[num_values:end] = piece_cols
+            values[num_values:end] = piece_values
+            num_values = end
+        return rows[:num_values], cols[:num_values], values[:num_values]
+
+    def build_state(self, train_matrix):
+        """Keep the ratings and item co-occurrence counts W_sparse was computed from"""
+        if self.scale is not None:
+            raise ValueError('Incremental updates need float32 weights')
+        self.ratings = sp.csr_matrix(train_matrix, dtype=np.float32)
+        self.ratings.data[:] = 1
+        self.cooccurrence = (self.ratings.T @ self.ratings).tocsr()
+
+    def update(self, delta_matrix, check_drift=False):
+        """
+        Add new (user, item) interactions and recompute the neighbours of the affected items only
+
+        Args:
+            delta_matrix: Sparse (users, items) matrix of interactions since the watermark
+            check_drift: Also recompute every item from the co-occurrence counts and report the largest difference
+
+        Returns:
+            Dict with the number of affected users and items, the elapsed seconds
+            and the drift against a full recompute (None unless checked)
+        """
+        if self.cooccurrence is None:
+            raise ValueError('No incremental state. Fit with build_state() or restore it with load_state() first.')
+        if self.scale is not None:
+            raise ValueError('Incremental updates need float32 weights')
+        start = time()
+
+        # new users and items grow every matrix
+        num_users = max(self.ratings.shape[0], delta_matrix.shape[0])
+        num_items = max(self.ratings.shape[1], delta_matrix.shape[1])
+        delta_matrix = sp.csr_matrix(delta_matrix, dtype=np.float32)
+        delta_matrix.resize(num_users, num_items)
+        delta_matrix.data[:] = 1
+        self.ratings.resize(num_users, num_items)
+        self.cooccurrence.resize(num_items, num_items)
+        W_sparse = sp.csr_matrix(self.W_sparse)
+        W_sparse.resize(num_items, num_items)
+
+        # co-occurrence changes only through the rows of users with new interactions
+        affected_users = np.flatnonzero(np.diff(delta_matrix.indptr))
+        old_rows = self.ratings[affected_users]
+        new_rows = old_rows + delta_matrix[affected_users]
+        new_rows.data[:] = 1
+        cooccurrence_delta = (new_rows.T @ new_rows - old_rows.T @ old_rows).tocsr()
+        cooccurrence_delta.eliminate_zeros()
+
+        self.ratings = self.ratings + delta_matrix
+        self.ratings.data[:] = 1
+        self.cooccurrence = (self.cooccurrence + cooccurrence_delta).tocsr()
+
+        # items with a changed count, plus every item co-occurring with an item whose norm changed
+        changed_norms = np.flatnonzero(cooccurrence_delta.diagonal())
+        affected_items = np.union1d(np.unique(cooccurrence_delta.indices),
+                                    self.cooccurrence[changed_norms].indices)
+
+        norms = np.sqrt(self.cooccurrence.diagonal())
+        pieces = []
+        for block_start in range(0, len(affected_items), self.block_size):
+            block_items = affected_items[block_start:block_start + self.block_size]
+            # symmetric, so rows of the block items are its (item, block) columns
+            block_weights = self.cooccurrence[block_items].toarray().T
+            pieces.append(_top_k_cosine(block_weights, norms, block_items, self.top_k, self.shrink))
+        rows, cols, values = self._collect_pieces(pieces, len(affected_items), num_items)
+
+        # replace the neighbour columns of the affected items
+        keep = np.ones(num_items, dtype=np.float32)
+        keep[affected_items] = 0
+        W_sparse = W_sparse @ sp.diags(keep)
+        W_sparse.eliminate_zeros()
+        self.W_sparse = (W_sparse + sp.csr_matrix((values, (rows, cols)), shape=(num_items, num_items))).tocsr()
+        self.num_items = num_items
+
+        stats = {
+            'users': len(affected_users),
+            'items': len(affected_items),
+            'seconds': time() - start,
+            'drift': None
+        }
+        if check_drift:
+            reference = ItemKNN(self.top_k, self.precision, self.block_size, shrink=self.shrink)
+            reference.fit(self.ratings, save_path=None)
+            # compare each column's sorted weights, neighbours tied in similarity may differ
+            reference_columns = _sorted_columns(reference.W_sparse)
+            updated_columns = _sorted_columns(self.W_sparse)
+            if len(reference_columns) != len(updated_columns):
+                stats['drift'] = float('inf')
+            else:
+                stats['drift'] = float(np.abs(reference_columns - updated_columns).max(initial=0.0))
+        return stats
+
+    def save_state(self, save_dir):
+        sp.save_npz(os.path.join(save_dir, f'{self.save_filename}_ratings'), self.ratings)
+        sp.save_npz(os.path.join(save_dir, f'{self.save_filename}_cooccurrence'), self.cooccurrence)
+        with open(os.path.join(save_dir, f'{self.save_filename}_state.json'), 'w') as f:
+            json.dump({'watermark': self.watermark.isoformat() if self.watermark else None}, f)
+
+    def load_state(self, save_dir):
+        """Restore the checkpoint in save_dir together with its incremental state"""
+        self.restore(os.path.join(save_dir, f'{self.save_filename}.npz'))
+        self.ratings = sp.load_npz(os.path.join(save_dir, f'{self.save_filename}_ratings.npz'))
+        self.cooccurrence = sp.load_npz(os.path.join(save_dir, f'{self.save_filename}_cooccurrence.npz'))
+        with open(os.path.join(save_dir, f'{self.save_filename}_state.json')) as f:
+            watermark = json.load(f)['watermark']
+        self.watermark = datetime.fromisoformat(watermark) if watermark else None
+
+    def quantized(self, precision):
+        """Copy of this model with W_sparse stored in the given precision"""
+        if self.scale is not None:
+            raise ValueError('Cannot requantize int8 weights')
+        model = ItemKNN(self.top_k, precision)
+        model.W_sparse, model.scale = quantize_csr(self.W_sparse, precision)
+        model.num_items = self.num_items
+        return model
 
     def predict(self, rating_matrix):
         input_matrix = rating_matrix
-        eval_output = input_matrix @ self.W_sparse
-        eval_output[rating_matrix.nonzero()] = float('-inf')
+        if self.scale is not None:
+            # upcasts only the rows of W_sparse for items in the input
+            eval_output = matmul(input_matrix, self.W_sparse, self.scale)
+        else:
+            eval_output = input_matrix @ self.W_sparse
         if not isinstance(eval_output, np.ndarray):
             eval_output = eval_output.toarray()
+        eval_output[rating_matrix.nonzero()] = float('-inf')
 
         return eval_output
         
+    def score_into(self, user_context, out):
+        """Write the scores of every item into out (float32, num_items), context items included"""
+        out[:] = 0
+        return accumulate_rows(self.W_sparse, self.scale, np.unique(user_context), out)
+
+    def candidates(self, user_context, num_candidates=200):
+        """
+        Candidates for a second stage ranker: the union of the neighbours (W_sparse rows)
+        of the context items, cut to the num_candidates with the highest ItemKNN score.
+        Reads only the context rows of W_sparse, never a whole catalog sized vector.
+        """
+        user_context = np.unique(user_context)
+        indptr = self.W_sparse.indptr
+
+        # positions of the context rows' entries, gathered without slicing the csr matrix
+        lengths = indptr[user_context + 1] - indptr[user_context]
+        ends = np.cumsum(lengths)
+        positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(indptr[user_context] - ends + lengths, lengths)
+        neighbours = self.W_sparse.indices[positions]
+        weights = self.W_sparse.data[positions].astype(np.float32)
+        if self.scale is not None:
+            weights *= np.repeat(self.scale[user_context], lengths)
+
+        if len(neighbours) >= self.dense_candidate_ratio * self.num_items:
+            # accumulate in a catalog sized buffer, cheaper than sorting the neighbours
+            scores = np.bincount(neighbours, weights=weights, minlength=self.num_items)
+            is_candidate = np.zeros(self.num_items, dtype=bool)
+            is_candidate[neighbours] = True
+            is_candidate[user_context] = False
+            items = np.flatnonzero(is_candidate)
+            scores = scores[items]
+        else:
+            items, inverse = np.unique(neighbours, return_inverse=True)
+            scores = np.bincount(inverse, weights=weights, minlength=len(items))
+            not_seen = ~np.isin(items, user_context)
+            items, scores = items[not_seen], scores[not_seen]
+        if len(items) > num_candidates:
+            items = items[np.argpartition(-scores, num_candidates - 1)[:num_candidates]]
+        return items
+
     def recommend(self, user_context, top_k=10):
         user_vec = np.zeros((1, self.num_items))
         user_vec[0, user_context] = 1
@@ -123,8 +373,17 @@ class ItemKNN:
         return recommendation.reshape(-1).tolist()
 
     def save(self, save_dir):
-        sp.save_npz(os.path.join(save_dir, self.save_filename), self.W_sparse)
+        save_csr(save_dir, self.save_filename, self.W_sparse)
+        if self.scale is not None:
+            np.save(os.path.join(save_dir, f'{self.save_filename}_scale'), self.scale)
+
+    def restore(self, ckpt, mmap_mode=None):
+        self.W_sparse = load_csr(ckpt, mmap_mode=mmap_mode)
+        self.num_items = self.W_sparse.shape[0]
 
-    def restore(self, ckpt):
-        self.W_sparse = sp.load_npz(ckpt)
-        self.num_items = self.W_sparse.shape[0]
\ No newline at end of file
+        scale_ckpt = f'{os.path.splitext(ckpt)[0]}_scale.npy'
+        if os.path.exists(scale_ckpt):
+            self.scale = np.load(scale_ckpt)
+            self.precision = 'int8'
+        else:
+            self.precision = str(self.W_sparse.dtype)
\ No newline at end of file
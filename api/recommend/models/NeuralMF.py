@@ -1,52 +1,212 @@
 """
-Neural Matrix Factorization Model (Placeholder)
-This is a placeholder for future neural network implementation.
+Matrix factorization for implicit feedback, trained with alternating least squares.
+Yifan Hu, Yehuda Koren, Chris Volinsky,
+Collaborative Filtering for Implicit Feedback Datasets.
+ICDM 2008.
 """
+import os
+import shutil
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import scipy.sparse as sp
+
+from recommend.ann import IVFIndex
+
+
+def _solve_rows(rating_matrix, factors, gramian, alpha):
+    """
+    Least squares factors of every row of a binary csr matrix against fixed `factors`:
+    (F^T F + reg * I + alpha * F_u^T F_u) x_u = (1 + alpha) * F_u^T 1
+    where F_u are the factors of the row's items and gramian = F^T F + reg * I.
+    """
+    num_rows = rating_matrix.shape[0]
+    row_lengths = np.diff(rating_matrix.indptr)
+    nonempty = np.flatnonzero(row_lengths)
+    solution = np.zeros((num_rows, factors.shape[1]), dtype=factors.dtype)
+    if len(nonempty) == 0:
+        return solution
+
+    row_factors = factors[rating_matrix.indices]
+    starts = rating_matrix.indptr[nonempty]
+    # per-row sums of the item factors and of their outer products
+    targets = np.add.reduceat(row_factors, starts, axis=0) * (1 + alpha)
+    outer = np.einsum('ni,nj->nij', row_factors, row_factors)
+    systems = np.add.reduceat(outer, starts, axis=0)
+    systems *= alpha
+    systems += gramian
+    solution[nonempty] = np.linalg.solve(systems, targets[:, :, np.newaxis])[:, :, 0]
+    return solution
+
 
 class NeuralMF:
     """
-    Neural Matrix Factorization model placeholder.
-    In production, this would use PyTorch or TensorFlow to implement
-    a neural collaborative filtering model.
+    Implicit matrix factorization, trained with alternating least squares (ALS).
+    Each half step solves the factors of a block of users (or items) as one batch
+    of small (factors, factors) systems, blocks are spread over threads. Contexts
+    are folded in at inference with one such solve and scored with one GEMV, or,
+    once build_index() was called, searched in an IVF index over the item factors.
     """
-    
-    def __init__(self):
+    # bytes of the (interactions, factors, factors) outer products built per block
+    block_bytes = 2**25
+
+    def __init__(self, factors=32, reg=1.0, alpha=10.0, iterations=15, n_threads=1, seed=0, n_probe=8):
+        self.factors = factors
+        self.reg = reg
+        # confidence of an observed interaction is 1 + alpha
+        self.alpha = alpha
+        self.iterations = iterations
+        self.n_threads = n_threads
+        self.seed = seed
+        # index lists scanned per request, trades recall for latency
+        self.n_probe = n_probe
+        self.precision = 'float32'
+
         self.num_items = 0
         self.num_users = 0
-        self.model_loaded = False
-        
-    def restore(self, checkpoint_path):
-        """Restore model from checkpoint"""
-        # Placeholder - would load trained neural network model
-        self.model_loaded = True
-        print(f"NeuralMF model placeholder loaded from {checkpoint_path}")
-        
-    def recommend(self, user_item_ids, top_k=10):
+        self.item_factors = None
+        # item_factors^T item_factors + reg * I, shared by every fold-in
+        self.gramian = None
+        # IVFIndex over item_factors, recommend() searches it when present
+        self.index = None
+
+    @property
+    def save_filename(self):
+        return f'NeuralMF_{self.factors}'
+
+    def _gramian(self, factors):
+        return factors.T @ factors + self.reg * np.eye(factors.shape[1], dtype=factors.dtype)
+
+    def _solve_blocks(self, rating_matrix, factors, gramian, executor=None):
+        """_solve_rows over row blocks of about block_bytes of outer products, optionally on a thread pool"""
+        block_nnz = max(self.block_bytes // (factors.shape[1] ** 2 * factors.itemsize), 1)
+        block_ids = rating_matrix.indptr[1:] // block_nnz
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(block_ids)) + 1, [rating_matrix.shape[0]]])
+        solution = np.empty((rating_matrix.shape[0], factors.shape[1]), dtype=factors.dtype)
+
+        def solve_block(block):
+            start, end = block
+            solution[start:end] = _solve_rows(rating_matrix[start:end], factors, gramian, self.alpha)
+
+        blocks = zip(bounds[:-1], bounds[1:])
+        list(executor.map(solve_block, blocks) if executor is not None else map(solve_block, blocks))
+        return solution
+
+    def fit(self, train_matrix, save_path):
+        self.num_users, self.num_items = train_matrix.shape
+        user_matrix = sp.csr_matrix(train_matrix, dtype=np.float32)
+        user_matrix.data[:] = 1
+        item_matrix = user_matrix.T.tocsr()
+
+        rng = np.random.default_rng(self.seed)
+        self.item_factors = (rng.standard_normal((self.num_items, self.factors)) * 0.01).astype(np.float32)
+
+        start = time()
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            for _ in range(self.iterations):
+                user_factors = self._solve_blocks(user_matrix, self.item_factors,
+                                                  self._gramian(self.item_factors), executor)
+                self.item_factors = self._solve_blocks(item_matrix, user_factors,
+                                                       self._gramian(user_factors), executor)
+        self.gramian = self._gramian(self.item_factors)
+        print(f'NeuralMF trained {self.iterations} ALS iterations in {time() - start:.2f}s')
+
+        # Save
+        if save_path is not None:
+            self.save(save_path)
+
+    def fold_in(self, rating_matrix):
+        """Factors of the users of a (users, items) matrix against the trained item factors"""
+        rating_matrix = sp.csr_matrix(rating_matrix, dtype=np.float32)
+        rating_matrix.data[:] = 1
+        return self._solve_blocks(rating_matrix, self.item_factors, self.gramian)
+
+    def predict(self, rating_matrix):
+        eval_output = self.fold_in(rating_matrix) @ self.item_factors.T
+        eval_output[rating_matrix.nonzero()] = float('-inf')
+        return eval_output
+
+    def context_factors(self, user_context):
+        """Factors of one context (list of item ids), folded in with one (factors, factors) solve"""
+        if self.item_factors is None:
+            raise ValueError("Model not loaded. Call restore() first.")
+        item_factors = self.item_factors[np.unique(user_context)]
+        system = self.gramian + self.alpha * (item_factors.T @ item_factors)
+        return np.linalg.solve(system, (1 + self.alpha) * item_factors.sum(axis=0))
+
+    def score(self, user_context):
+        user_context = np.unique(user_context)
+        scores = self.item_factors @ self.context_factors(user_context)
+
+        scores[user_context] = float('-inf')
+        return scores
+
+    def score_into(self, user_context, out):
+        """Write the scores of every item into out (float32, num_items), context items included"""
+        return np.dot(self.item_factors, self.context_factors(user_context).astype(self.item_factors.dtype), out=out)
+
+    def score_candidates(self, user_context, candidates):
+        """Scores of the candidate items only"""
+        return self.item_factors[candidates] @ self.context_factors(user_context)
+
+    def build_index(self, num_lists=None, iterations=20):
+        """Cluster the item factors into an IVF index with num_lists lists (default: sqrt of the items)"""
+        self.index = IVFIndex.build(self.item_factors, num_lists, iterations, seed=self.seed)
+
+    def recommend(self, user_context, top_k=10, n_probe=None):
         """
         Generate recommendations for user based on their item history
-        
+
         Args:
-            user_item_ids: List of item IDs the user has interacted with
+            user_context: List of item IDs the user has interacted with
             top_k: Number of recommendations to return
-            
+            n_probe: Index lists scanned (default: self.n_probe), ignored without an index
+
         Returns:
             List of recommended item IDs
         """
-        if not self.model_loaded:
-            raise ValueError("Model not loaded. Call restore() first.")
-        
-        # Placeholder implementation
-        # In production, this would:
-        # 1. Encode user-item interactions
-        # 2. Pass through neural network
-        # 3. Get item embeddings
-        # 4. Compute similarity scores
-        # 5. Return top-k items
-        
-        print(f"NeuralMF: Generating recommendations for user with {len(user_item_ids)} items")
-        print("Note: This is a placeholder. Neural network implementation coming soon.")
-        
-        # Return empty list for now
-        return []
+        if self.index is not None:
+            user_factors = self.context_factors(user_context)
+            n_probe = n_probe if n_probe is not None else self.n_probe
+            return self.index.search(user_factors, top_k, n_probe, exclude=user_context).tolist()
+
+        prediction = self.score(user_context)
+        top_k = min(top_k, self.num_items)
+
+        relevant_items_partition = np.argpartition(-prediction, top_k - 1)[:top_k]
+        recommendation = relevant_items_partition[np.argsort(-prediction[relevant_items_partition])]
+        return recommendation.tolist()
+
+    def save(self, save_dir):
+        ckpt = os.path.join(save_dir, f'{self.save_filename}.npz')
+        np.savez(ckpt, item_factors=self.item_factors, reg=self.reg, alpha=self.alpha, n_probe=self.n_probe)
+        # raw copy of the factors (and index) for memory mapping
+        raw_dir = os.path.join(save_dir, self.save_filename)
+        os.makedirs(raw_dir, exist_ok=True)
+        np.save(os.path.join(raw_dir, 'item_factors.npy'), self.item_factors)
+        index_dir = os.path.join(raw_dir, 'ivf')
+        if self.index is not None:
+            self.index.save(index_dir)
+        else:
+            shutil.rmtree(index_dir, ignore_errors=True)
+
+    def restore(self, ckpt, mmap_mode=None):
+        """Restore model from checkpoint"""
+        with np.load(ckpt) as checkpoint:
+            self.reg = float(checkpoint['reg'])
+            self.alpha = float(checkpoint['alpha'])
+            if 'n_probe' in checkpoint:
+                self.n_probe = int(checkpoint['n_probe'])
+            raw_dir = os.path.splitext(ckpt)[0]
+            raw_factors = os.path.join(raw_dir, 'item_factors.npy')
+            if mmap_mode is not None and os.path.exists(raw_factors):
+                self.item_factors = np.load(raw_factors, mmap_mode=mmap_mode)
+            else:
+                self.item_factors = checkpoint['item_factors']
 
+        self.num_items, self.factors = self.item_factors.shape
+        self.precision = str(self.item_factors.dtype)
+        self.gramian = self._gramian(self.item_factors)
+        index_dir = os.path.join(raw_dir, 'ivf')
+        self.index = IVFIndex.load(index_dir, mmap_mode=mmap_mode) if os.path.isdir(index_dir) else None
@@ -10,8 +10,8 @@ BASE_DIR = 'recommend/ckpt'
 model_to_ckpt = {
     'EASE': os.path.join(BASE_DIR, 'EASE_100.npy'),
     'ItemKNN': os.path.join(BASE_DIR, 'ItemKNN_100.npz'),
-    'NeuralMF': os.path.join(BASE_DIR, 'NeuralMF_placeholder.pth'),  # Placeholder
-    'DeepFM': os.path.join(BASE_DIR, 'DeepFM_placeholder.pth')  # Placeholder
+    'NeuralMF': os.path.join(BASE_DIR, 'NeuralMF_32.npz'),
+    'DeepFM': os.path.join(BASE_DIR, 'DeepFM_16.npz')
 }
 
 model_to_cls = {
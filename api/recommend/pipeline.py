@@ -0,0 +1,199 @@
+"""
+Training stage of fit_offline.py: fit and evaluate (model, hyperparameters)
+configurations on one shared train/test split, either in the calling process
+or concurrently in a pool of worker processes within a CPU budget.
+"""
+import os
+import ast
+import inspect
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+from time import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from recommend.models import model_to_cls
+from recommend.evaluate import evaluate_streaming
+
+# everything a worker needs besides the configuration, sent to each worker process once
+Split = namedtuple('Split', ['train_matrix', 'test_matrix', 'gram', 'features', 'eval_ks', 'eval_chunk_size',
+                             'eval_threads'])
+
+TrainResult = namedtuple('TrainResult', ['model_name', 'params', 'model', 'scores', 'fit_time', 'sweep_table'])
+
+# thread pools of the BLAS / OpenMP runtimes numpy may be linked against
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def parse_value(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def parse_params(params):
+    # 'reg=200,solver=cholesky' -> {'reg': 200, 'solver': 'cholesky'}
+    return {key: parse_value(value) for key, value in (param.split('=', 1) for param in params.split(',') if param)}
+
+
+def parse_grid(spec, model_names):
+    """
+    Expand hyperparameter grids into (model_name, params) configurations
+
+    'reg=100|300,solver=cholesky' applies to every model whose constructor takes
+    the parameter, per-model grids are separated by ';', prefixed with the model name
+    and merged over those, e.g. 'reg=100|300;ItemKNN:top_k=50|100,shrink=10'.
+    '|' separates the values tried. Raises ValueError for unknown models and for
+    parameters no selected model (or not the prefixed one) takes, before any training.
+    """
+    global_grid, model_grids = {}, {}
+    for model_spec in spec.split(';'):
+        name, _, params = model_spec.rpartition(':')
+        grid = {key: [parse_value(value) for value in values.split('|')]
+                for key, values in (param.split('=', 1) for param in params.split(',') if param)}
+        if name:
+            model_grids.setdefault(name, {}).update(grid)
+        else:
+            global_grid.update(grid)
+
+    unknown_models = [name for name in set(model_names) | set(model_grids) if name not in model_to_cls]
+    if unknown_models:
+        raise ValueError(f'Unknown models {unknown_models}, choose from {list(model_to_cls)}')
+    accepted = {name: set(inspect.signature(model_to_cls[name]).parameters) for name in model_names}
+    for name, grid in model_grids.items():
+        if name not in model_names:
+            raise ValueError(f'--params for {name}, which is not in --model')
+        unknown = set(grid) - accepted[name]
+        if unknown:
+            raise ValueError(f'{name} does not take {sorted(unknown)}')
+    unused = [key for key in global_grid if not any(key in accepted[name] for name in model_names)]
+    if unused:
+        raise ValueError(f'None of {model_names} takes {unused}')
+
+    configs = []
+    for model_name in model_names:
+        grid = {key: values for key, values in global_grid.items() if key in accepted[model_name]}
+        grid.update(model_grids.get(model_name, {}))
+        for values in itertools.product(*grid.values()):
+            configs.append((model_name, dict(zip(grid.keys(), values))))
+    return configs
+
+
+def format_params(params):
+    return ','.join(f'{key}={value}' for key, value in params.items()) or '-'
+
+
+_split = None
+
+
+def _init_worker(split):
+    global _split
+    _split = split
+
+
+def train_config(model_name, params, regs=None, sweep_metric=None, split=None):
+    """
+    Fit one configuration on the split and evaluate it
+
+    With regs (models with a sweep classmethod), every reg is evaluated from one
+    factorization and the best by sweep_metric is kept; the other params go to sweep().
+    """
+    split = split if split is not None else _split
+    model_cls = model_to_cls[model_name]
+    # shared inputs the model's fit() accepts
+    fit_kwargs = {}
+    if split.gram is not None and getattr(model_cls, 'uses_gram', False):
+        fit_kwargs['gram'] = split.gram
+    if split.features is not None and getattr(model_cls, 'uses_features', False):
+        fit_kwargs['features'] = split.features
+
+    def evaluate_model(model):
+        return evaluate_streaming(model, split.train_matrix, split.test_matrix, split.eval_ks,
+                                  chunk_size=split.eval_chunk_size, n_threads=split.eval_threads)
+
+    start = time()
+    sweep_table = None
+    if regs and hasattr(model_cls, 'sweep'):
+        model, scores, sweep_table = None, None, []
+        sweep_params = {key: value for key, value in params.items() if key != 'reg'}
+        for candidate in model_cls.sweep(split.train_matrix, regs, **sweep_params, **fit_kwargs):
+            candidate_scores = evaluate_model(candidate)
+            sweep_table.append((candidate.reg, candidate_scores))
+            if scores is None or candidate_scores[sweep_metric] > scores[sweep_metric]:
+                model, scores = candidate, candidate_scores
+        params = dict(params, reg=model.reg)
+    else:
+        model = model_cls(**params)
+        model.fit(split.train_matrix, save_path=None, **fit_kwargs)
+        scores = evaluate_model(model)
+    return TrainResult(model_name, params, model, scores, time() - start, sweep_table)
+
+
+def train_all(configs, split, jobs=1, cpus=None, regs=None, sweep_metric=None):
+    """
+    Train every (model_name, params) configuration on the same split
+
+    Args:
+        configs: List of (model_name, params)
+        split: Split shared by all configurations
+        jobs: Configurations trained concurrently, each in its own process
+        cpus: CPU budget shared by the jobs (default: all cpus), each process
+            limits its BLAS threads to cpus // jobs
+    """
+    jobs = max(1, min(jobs, len(configs)))
+    if jobs == 1:
+        return [train_config(model_name, params, regs, sweep_metric, split=split) for model_name, params in configs]
+
+    threads = max(1, (cpus or os.cpu_count()) // jobs)
+    saved_env = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    os.environ.update({name: str(threads) for name in THREAD_ENV_VARS})
+    try:
+        # spawned workers import numpy afresh, so they pick up the thread limits
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(jobs, mp_context=context, initializer=_init_worker, initargs=(split,)) as pool:
+            futures = [pool.submit(train_config, model_name, params, regs, sweep_metric)
+                       for model_name, params in configs]
+            return [future.result() for future in futures]
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def replace_into(staging_dir, save_dir):
+    """Move every file and directory of staging_dir into save_dir, replacing existing entries"""
+    for name in os.listdir(staging_dir):
+        source, target = os.path.join(staging_dir, name), os.path.join(save_dir, name)
+        if os.path.isdir(source) and os.path.isdir(target):
+            # directories cannot be replaced in one rename, swap the old one out first
+            old = tempfile.mkdtemp(prefix='.old-', dir=save_dir)
+            os.replace(target, os.path.join(old, name))
+            os.replace(source, target)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.replace(source, target)
+
+
+class CheckpointWriter:
+    """
+    Context manager collecting checkpoints in a staging directory inside save_dir.
+    They are moved into save_dir only when the block succeeds, so a failed run
+    never leaves a partial set of checkpoints behind.
+    """
+    def __init__(self, save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+        self.save_dir = save_dir
+        self.staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=save_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            replace_into(self.staging_dir, self.save_dir)
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
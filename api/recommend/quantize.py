@@ -0,0 +1,114 @@
+"""
+Reduced-precision storage for item x item weights.
+
+Weights are stored as float64, float32, float16 or int8. int8 weights carry one
+float32 scale per row (w[i] ~= q[i] * scale[i]). Scoring only ever upcasts the
+rows of the weights that a context touches, and accumulates in float32.
+"""
+import numpy as np
+import scipy.sparse as sp
+
+PRECISIONS = ['float64', 'float32', 'float16', 'int8']
+# scipy.sparse has no float16
+SPARSE_PRECISIONS = ['float64', 'float32', 'int8']
+
+# rows quantized / gathered per step, bounds the float temporaries
+BLOCK_SIZE = 1024
+
+
+def _check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f'precision must be one of {PRECISIONS}')
+
+
+def quantize_dense(weights, precision):
+    """Return (weights, scale) for a dense matrix; scale is None unless precision is int8"""
+    _check_precision(precision)
+    if precision != 'int8':
+        return weights.astype(precision), None
+
+    num_rows = weights.shape[0]
+    scale = np.empty(num_rows, dtype=np.float32)
+    quantized = np.empty(weights.shape, dtype=np.int8)
+    for start in range(0, num_rows, BLOCK_SIZE):
+        block = weights[start:start + BLOCK_SIZE]
+        block_scale = np.abs(block).max(axis=1) / 127
+        block_scale[block_scale == 0] = 1
+        quantized[start:start + BLOCK_SIZE] = np.rint(block / block_scale[:, None])
+        scale[start:start + BLOCK_SIZE] = block_scale
+    return quantized, scale
+
+
+def quantize_csr(weights, precision):
+    """Return (weights, scale) for a csr matrix; scale is None unless precision is int8"""
+    if precision not in SPARSE_PRECISIONS:
+        raise ValueError(f'precision of sparse weights must be one of {SPARSE_PRECISIONS}')
+    if precision != 'int8':
+        return weights.astype(precision), None
+
+    weights = weights.tocsr()
+    row_max = np.zeros(weights.shape[0], dtype=np.float32)
+    row_lengths = np.diff(weights.indptr)
+    nonempty = row_lengths > 0
+    row_max[nonempty] = np.maximum.reduceat(np.abs(weights.data), weights.indptr[:-1][nonempty])
+    scale = row_max / 127
+    scale[scale == 0] = 1
+
+    data = np.rint(weights.data / np.repeat(scale, row_lengths)).astype(np.int8)
+    quantized = sp.csr_matrix((data, weights.indices.copy(), weights.indptr.copy()), shape=weights.shape)
+    return quantized, scale
+
+
+def gather_rows(weights, scale, rows):
+    """Upcast only `rows` of the (dense or csr) weights to float32 and undo the int8 scale"""
+    if sp.issparse(weights):
+        block = weights[rows].astype(np.float32)
+        if scale is not None:
+            block = sp.diags(scale[rows]) @ block
+        return block
+
+    block = weights[rows].astype(np.float32)
+    if scale is not None:
+        block *= scale[rows, np.newaxis]
+    return block
+
+
+def matmul(rating_matrix, weights, scale):
+    """
+    rating_matrix @ dequantized(weights), reading only the rows of the weights
+    for items that appear in rating_matrix. Returns a dense float32 array.
+    """
+    rating_matrix = sp.csr_matrix(rating_matrix)
+    output = np.zeros((rating_matrix.shape[0], weights.shape[1]), dtype=np.float32)
+
+    rows = np.unique(rating_matrix.indices)
+    for start in range(0, len(rows), BLOCK_SIZE):
+        block_rows = rows[start:start + BLOCK_SIZE]
+        block_output = rating_matrix[:, block_rows] @ gather_rows(weights, scale, block_rows)
+        if sp.issparse(block_output):
+            block_output = block_output.toarray()
+        output += block_output
+    return output
+
+
+def accumulate_rows(weights, scale, rows, out):
+    """
+    out += the sum of the dequantized `rows` of the (dense or csr) weights, added one
+    row at a time so no (len(rows), items) block is ever gathered
+    """
+    if sp.issparse(weights):
+        for row in rows:
+            start, end = weights.indptr[row], weights.indptr[row + 1]
+            values = weights.data[start:end].astype(np.float32)
+            if scale is not None:
+                values *= scale[row]
+            # column indices are unique within a row
+            out[weights.indices[start:end]] += values
+        return out
+
+    for row in rows:
+        if scale is None:
+            out += weights[row]
+        else:
+            out += weights[row] * scale[row]
+    return out
@@ -1,24 +1,261 @@
-import pickle
-import numpy as np
-
-from recommend.models import model_to_ckpt, model_to_cls
-
-class RecommenderWrapper:
-    def __init__(self) -> None:
-        self.model_name = None
-        self.model = None
-    
-    def set_model(self, new_model):
-        if self.model == None or self.model_name != new_model:
-            self.model_name = new_model
-            self.model = model_to_cls[new_model]()
-            self.model.restore(model_to_ckpt[new_model])
-        
-    def recommend(self, user_context):
-        # user context to user vec
-        user_item_ids = [int(i) for i in user_context]
-
-        # recommend
-        recommendation = self.model.recommend(user_item_ids)
-
-        return recommendation
+import logging
+import threading
+from time import time
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse as sp
+
+from recommend.models import model_to_ckpt, model_to_cls
+from recommend.utils import contexts_to_matrix
+from recommend.evaluate import extract_top_k
+from recommend.ann import IVFIndex
+
+logger = logging.getLogger(__name__)
+
+# immutable view of a resident model, handed out to each request
+ModelHandle = namedtuple('ModelHandle', ['name', 'model', 'ckpt', 'load_time', 'nbytes'])
+
+
+def weight_arrays(model):
+    """Yield every numpy array held by the model, including the parts of sparse matrices"""
+    for value in vars(model).values():
+        if sp.issparse(value):
+            yield from (getattr(value, attr) for attr in ('data', 'indices', 'indptr') if hasattr(value, attr))
+        elif isinstance(value, np.ndarray):
+            yield value
+        elif isinstance(value, IVFIndex):
+            yield from weight_arrays(value)
+        elif isinstance(value, dict):
+            yield from (array for array in value.values() if isinstance(array, np.ndarray))
+
+
+def _freeze(model):
+    """Mark the model's weight arrays read-only and return their total size in bytes"""
+    nbytes = 0
+    for array in weight_arrays(model):
+        nbytes += array.nbytes
+        array.flags.writeable = False
+    return nbytes
+
+
+def _standardize(scores):
+    """Shift and scale scores in place to zero mean and unit variance"""
+    mean = scores.mean()
+    variance = np.dot(scores, scores) / len(scores) - mean ** 2
+    scores -= mean
+    if variance > 0:
+        scores /= np.sqrt(variance)
+    return scores
+
+
+def check_item_ids(user_item_ids, num_items):
+    """Raise ValueError unless every item id is in [0, num_items)"""
+    if num_items and any(i < 0 or i >= num_items for i in user_item_ids):
+        raise ValueError(f'Item ids must be in [0, {num_items})')
+
+
+def rerank(model, candidate_model, user_context, top_k=10, num_candidates=200):
+    """
+    Two-stage recommendation: candidate_model.candidates() retrieves up to num_candidates
+    items, model.score_candidates() scores only those within its own catalog
+
+    Returns:
+        List of recommended item IDs, fewer than top_k when there are fewer candidates
+    """
+    candidates = candidate_model.candidates(user_context, num_candidates)
+    # the candidate model may know newer items than the reranker (ItemKNN.update grows its catalog)
+    candidates = candidates[candidates < model.num_items]
+    top_k = min(top_k, len(candidates))
+    if top_k == 0:
+        return []
+    scores = model.score_candidates(user_context, candidates)
+
+    relevant_items_partition = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[relevant_items_partition[np.argsort(-scores[relevant_items_partition])]].tolist()
+
+
+class ModelRegistry:
+    """
+    Keeps every checkpoint in `model_to_ckpt` resident in memory.
+    Each model is restored at most once; concurrent requests share the loaded handle.
+    With mmap=True, checkpoints are memory mapped read-only, so worker processes
+    serving the same checkpoint share one physical copy of the weights.
+    """
+    def __init__(self, preload=False, mmap=False):
+        self.mmap_mode = 'r' if mmap else None
+        self._handles = {}
+        self._errors = {}
+        self._locks = {name: threading.Lock() for name in model_to_ckpt}
+
+        if preload:
+            self.load_all()
+
+    def load_all(self):
+        for name in model_to_ckpt:
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.warning(f"Skip preloading {name}: {str(e)}")
+
+    def get(self, name):
+        handle = self._handles.get(name)
+        if handle is not None:
+            return handle
+
+        if name not in self._locks:
+            raise KeyError(name)
+
+        with self._locks[name]:
+            # another thread may have finished loading while we waited
+            handle = self._handles.get(name)
+            if handle is None:
+                handle = self._load(name)
+                self._handles[name] = handle
+        return handle
+
+    def _load(self, name):
+        ckpt = model_to_ckpt[name]
+
+        start = time()
+        model = model_to_cls[name]()
+        try:
+            model.restore(ckpt, mmap_mode=self.mmap_mode)
+        except Exception as e:
+            self._errors[name] = str(e)
+            raise
+        load_time = time() - start
+        nbytes = _freeze(model)
+
+        self._errors.pop(name, None)
+        logger.info(f"Loaded {name} from {ckpt} in {load_time:.3f}s ({nbytes / 2**20:.1f} MiB"
+                    f"{', memory mapped' if self.mmap_mode else ''})")
+        return ModelHandle(name, model, ckpt, load_time, nbytes)
+
+    def stats(self):
+        stats = {}
+        for name in model_to_ckpt:
+            handle = self._handles.get(name)
+            if handle is not None:
+                stats[name] = {
+                    'loaded': True,
+                    'checkpoint': handle.ckpt,
+                    'load_time_sec': round(handle.load_time, 6),
+                    'memory_bytes': handle.nbytes,
+                    'memory_mapped': self.mmap_mode is not None
+                }
+            else:
+                stats[name] = {'loaded': False, 'error': self._errors.get(name)}
+        return stats
+
+
+class RecommenderWrapper:
+    # rows scored per predict call, bounds the dense (rows, num_items) score matrix
+    batch_chunk_size = 1024
+
+    def __init__(self, registry=None) -> None:
+        self.registry = registry if registry is not None else ModelRegistry()
+        # per-thread (blend, model scores) buffers of recommend_blend
+        self._local = threading.local()
+
+    def get_model(self, model_name):
+        return self.registry.get(model_name)
+
+    def recommend(self, model_name, user_context, candidate_model=None, num_candidates=200):
+        """
+        Recommend with one model, scoring the whole catalog, or, with candidate_model,
+        rerank only the candidates that model retrieves (see rerank)
+        """
+        handle = self.get_model(model_name)
+
+        # user context to user vec
+        user_item_ids = [int(i) for i in user_context]
+
+        if candidate_model is not None:
+            candidate_handle = self.get_model(candidate_model)
+            if not hasattr(candidate_handle.model, 'candidates'):
+                raise ValueError(f'{candidate_model} cannot generate candidates')
+            if not hasattr(handle.model, 'score_candidates'):
+                raise ValueError(f'{model_name} cannot score candidates')
+            check_item_ids(user_item_ids, min(handle.model.num_items, candidate_handle.model.num_items))
+            return rerank(handle.model, candidate_handle.model, user_item_ids, num_candidates=num_candidates)
+
+        # negative ids would silently index from the end of the catalog
+        check_item_ids(user_item_ids, getattr(handle.model, 'num_items', None))
+
+        # recommend
+        recommendation = handle.model.recommend(user_item_ids)
+
+        return recommendation
+
+    def _score_buffers(self, num_items):
+        buffers = getattr(self._local, 'score_buffers', None)
+        if buffers is None or buffers.shape[1] != num_items:
+            buffers = np.empty((2, num_items), dtype=np.float32)
+            self._local.score_buffers = buffers
+        return buffers
+
+    def recommend_blend(self, model_weights, user_context, top_k=10):
+        """
+        Recommend from a weighted blend of models, e.g. {'EASE': 0.7, 'ItemKNN': 0.3}
+
+        The context is parsed once. Every model writes its scores into the same
+        preallocated per-thread buffer, where they are standardized (zero mean, unit
+        variance) and added to the blend with the model's weight; one top-k follows.
+        """
+        models = {name: self.get_model(name).model for name in model_weights}
+        for name, model in models.items():
+            if not hasattr(model, 'score_into'):
+                raise ValueError(f'{name} cannot be blended')
+        num_items = {model.num_items for model in models.values()}
+        if len(num_items) != 1:
+            raise ValueError('Blended models must share one item catalog')
+        num_items = num_items.pop()
+
+        user_item_ids = np.unique([int(i) for i in user_context])
+        check_item_ids(user_item_ids, num_items)
+
+        blend, scores = self._score_buffers(num_items)
+        blend[:] = 0
+        for name, model in models.items():
+            model.score_into(user_item_ids, scores)
+            _standardize(scores)
+            scores *= model_weights[name]
+            blend += scores
+        blend[user_item_ids] = float('-inf')
+
+        top_k = min(top_k, num_items - len(user_item_ids))
+        if top_k <= 0:
+            return []
+        relevant_items_partition = np.argpartition(-blend, top_k - 1)[:top_k]
+        return relevant_items_partition[np.argsort(-blend[relevant_items_partition])].tolist()
+
+    def recommend_batch(self, model_name, contexts, top_ks):
+        """
+        Score many contexts with one sparse (users, items) matrix per chunk
+
+        Args:
+            model_name: Name of a registered model
+            contexts: List of contexts, each a list of item IDs
+            top_ks: Number of recommendations to return for each context
+
+        Returns:
+            List of recommended item ID lists, one per context
+        """
+        model = self.get_model(model_name).model
+
+        # models without a batch predict fall back to one call per context
+        if not hasattr(model, 'predict'):
+            return [model.recommend(context, top_k=k) for context, k in zip(contexts, top_ks)]
+
+        results = []
+        for start in range(0, len(contexts), self.batch_chunk_size):
+            chunk_contexts = contexts[start:start + self.batch_chunk_size]
+            chunk_top_ks = top_ks[start:start + self.batch_chunk_size]
+
+            context_matrix = contexts_to_matrix(chunk_contexts, model.num_items)
+            prediction = model.predict(context_matrix)
+            topk = extract_top_k(prediction, max(chunk_top_ks))
+
+            results.extend(row[:k].tolist() for row, k in zip(topk, chunk_top_ks))
+        return results
@@ -0,0 +1,144 @@
+import logging
+import threading
+from time import perf_counter
+from queue import Queue, Empty
+from collections import deque, Counter
+from concurrent.futures import Future
+
+import numpy as np
+
+from recommend.recommender import check_item_ids
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    __slots__ = ('context', 'top_k', 'future', 'enqueued')
+
+    def __init__(self, context, top_k):
+        self.context = context
+        self.top_k = top_k
+        self.future = Future()
+        self.enqueued = perf_counter()
+
+
+class MicroBatchScheduler:
+    """
+    Coalesces concurrent single-context requests into one batched predict per model.
+
+    A per-model worker waits for the first request, then keeps collecting until
+    `max_batch_size` requests are queued or `max_wait_ms` has passed since the first
+    one arrived. The batch is scored with `RecommenderWrapper.recommend_batch` and
+    each result is handed back to its waiting caller.
+    """
+    def __init__(self, wrapper, max_batch_size=32, max_wait_ms=2.0, num_delay_samples=10000):
+        self.wrapper = wrapper
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._queues = {}
+        self._workers = {}
+        self._lock = threading.Lock()
+
+        # metrics
+        self._metrics_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._num_requests = 0
+        self._num_batches = 0
+        self._queue_delays = deque(maxlen=num_delay_samples)
+        self._predict_times = deque(maxlen=num_delay_samples)
+
+    def submit(self, model_name, user_context, top_k=10, timeout=None):
+        """Queue one context and block until its recommendation is ready"""
+        # resolve (and validate) here so one bad request cannot fail a whole batch
+        model = self.wrapper.get_model(model_name).model
+        user_item_ids = [int(i) for i in user_context]
+        check_item_ids(user_item_ids, getattr(model, 'num_items', None))
+
+        # a batched predict() scores exactly, which would bypass an ANN index and its n_probe
+        if getattr(model, 'index', None) is not None:
+            return model.recommend(user_item_ids, top_k)
+
+        request = _Request(user_item_ids, top_k)
+        self._get_queue(model_name).put(request)
+        return request.future.result(timeout=timeout)
+
+    def _get_queue(self, model_name):
+        queue = self._queues.get(model_name)
+        if queue is not None:
+            return queue
+
+        with self._lock:
+            if model_name not in self._queues:
+                queue = Queue()
+                worker = threading.Thread(target=self._run, args=(model_name, queue),
+                                          name=f'microbatch-{model_name}', daemon=True)
+                self._queues[model_name] = queue
+                self._workers[model_name] = worker
+                worker.start()
+        return self._queues[model_name]
+
+    def _collect(self, queue):
+        batch = [queue.get()]
+        deadline = batch[0].enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                # drain whatever is already waiting without blocking
+                try:
+                    batch.append(queue.get_nowait())
+                    continue
+                except Empty:
+                    break
+            try:
+                batch.append(queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _run(self, model_name, queue):
+        while True:
+            batch = self._collect(queue)
+            start = perf_counter()
+            try:
+                results = self.wrapper.recommend_batch(model_name,
+                                                       [request.context for request in batch],
+                                                       [request.top_k for request in batch])
+            except Exception as e:
+                logger.error(f"Batched recommendation error for {model_name}: {str(e)}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            end = perf_counter()
+
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+
+            with self._metrics_lock:
+                self._num_batches += 1
+                self._num_requests += len(batch)
+                self._batch_sizes[len(batch)] += 1
+                self._queue_delays.extend(start - request.enqueued for request in batch)
+                self._predict_times.append(end - start)
+
+    def metrics(self):
+        with self._metrics_lock:
+            queue_delays = np.array(self._queue_delays)
+            predict_times = np.array(self._predict_times)
+            metrics = {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'num_requests': self._num_requests,
+                'num_batches': self._num_batches,
+                'mean_batch_size': self._num_requests / self._num_batches if self._num_batches else 0.0,
+                'batch_size_histogram': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'pending': {name: queue.qsize() for name, queue in self._queues.items()}
+            }
+
+        for name, samples in (('queue_delay_ms', queue_delays), ('predict_ms', predict_times)):
+            if len(samples) > 0:
+                p50, p99 = np.percentile(samples, [50, 99]) * 1000
+                metrics[name] = {'mean': samples.mean() * 1000, 'p50': p50, 'p99': p99, 'max': samples.max() * 1000}
+            else:
+                metrics[name] = {'mean': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+        return metrics
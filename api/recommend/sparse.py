@@ -0,0 +1,80 @@
+"""
+Helpers shared by the models that serve sparse item x item weights.
+"""
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def top_k_per_column(block, k, start_col=0, by_magnitude=False):
+    """
+    Keep the k largest entries of every column of a dense (items, block) matrix
+
+    Args:
+        block: Dense array whose column c holds the weights of item start_col + c
+        k: Number of entries kept per column
+        start_col: Item index of the first column of the block
+        by_magnitude: Rank entries by absolute value instead of value
+
+    Returns:
+        (rows, cols, values) of the kept non-zero entries
+    """
+    num_rows, num_cols = block.shape
+    k = min(k, num_rows)
+    # (block, items) so that each item's candidates are one contiguous row
+    keys = np.abs(block.T) if by_magnitude else block.T
+
+    if k < num_rows:
+        top_k_idx = np.argpartition(-keys, k - 1, axis=1)[:, :k]
+    else:
+        top_k_idx = np.broadcast_to(np.arange(num_rows), (num_cols, num_rows))
+    values = np.take_along_axis(block.T, top_k_idx, axis=1)
+
+    cols = np.broadcast_to(np.arange(start_col, start_col + num_cols)[:, np.newaxis], top_k_idx.shape)
+    nonzero = values != 0
+    return top_k_idx[nonzero], cols[nonzero], values[nonzero]
+
+
+def top_k_per_sparse_column(matrix, k):
+    """
+    Keep the k largest stored entries of every column of a sparse matrix, without densifying it
+
+    Returns:
+        (rows, cols, values) of the kept non-zero entries
+    """
+    matrix = sp.csc_matrix(matrix)
+    matrix.eliminate_zeros()
+    lengths = np.diff(matrix.indptr)
+    cols = np.repeat(np.arange(matrix.shape[1]), lengths)
+
+    # entries grouped by column (the same ranges as indptr), largest first within each column
+    order = np.lexsort((-matrix.data, cols))
+    rank = np.arange(matrix.nnz) - np.repeat(matrix.indptr[:-1], lengths)
+    keep = order[rank < k]
+    return matrix.indices[keep], cols[keep], matrix.data[keep]
+
+
+def save_csr_raw(raw_dir, matrix):
+    """Write the csr arrays as uncompressed .npy files so they can be memory mapped"""
+    os.makedirs(raw_dir, exist_ok=True)
+    for name in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(raw_dir, f'{name}.npy'), getattr(matrix, name))
+    np.save(os.path.join(raw_dir, 'shape.npy'), np.array(matrix.shape))
+
+
+def save_csr(save_dir, filename, matrix):
+    """Save a csr matrix as .npz plus the raw layout used for memory mapping"""
+    sp.save_npz(os.path.join(save_dir, filename), matrix)
+    save_csr_raw(os.path.join(save_dir, filename), matrix)
+
+
+def load_csr(ckpt, mmap_mode=None):
+    """Load a csr matrix from an .npz, memory mapping the raw layout next to it when mmap_mode is given"""
+    raw_dir = ckpt if os.path.isdir(ckpt) else os.path.splitext(ckpt)[0]
+    if os.path.isdir(raw_dir) and (mmap_mode is not None or raw_dir == ckpt):
+        arrays = [np.load(os.path.join(raw_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+                  for name in ('data', 'indices', 'indptr')]
+        shape = tuple(np.load(os.path.join(raw_dir, 'shape.npy')))
+        return sp.csr_matrix(tuple(arrays), shape=shape, copy=False)
+    return sp.load_npz(ckpt)
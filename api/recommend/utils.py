@@ -1,48 +1,218 @@
+import itertools
+import tracemalloc
+from time import time
+from contextlib import contextmanager
+
 import numpy as np
 import scipy.sparse as sp
+from sqlalchemy import func
 from tqdm import tqdm
 
-def load_rating_matrix_from_db(users, interactions):
-    all_users = users.query.all()
-    all_interactions = interactions.query.all()
+@contextmanager
+def log_phase(name):
+    """Print the wall time of a block, and its peak traced memory when tracemalloc is running"""
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    start = time()
+    yield
+    message = f'[{name}] {time() - start:.2f}s'
+    if tracing:
+        message += f', peak memory {tracemalloc.get_traced_memory()[1] / 2**20:.1f} MB'
+    print(message)
+
+def load_rating_matrix_from_db(users, interactions, interaction_types=None, implicit=True, chunk_size=100000):
+    """
+    (users, items) csr rating matrix, streamed from the interaction columns in chunks
+
+    Args:
+        users: User model, its largest id sets the number of rows
+        interactions: Interaction model
+        interaction_types: Only load these interaction types (default: all)
+        implicit: Use 1 for every interaction instead of its rating
+        chunk_size: Rows fetched from the database per round trip
+    """
+    query = interactions.query.with_entities(interactions.user_id, interactions.movie_id,
+                                             interactions.rating, interactions.interaction_type)
+    if interaction_types is not None:
+        query = query.filter(interactions.interaction_type.in_(interaction_types))
 
-    users = []
-    items = []
-    ratings = []
+    num_interactions = query.count()
+    user_ids = np.empty(num_interactions, dtype=np.int64)
+    item_ids = np.empty(num_interactions, dtype=np.int64)
+    ratings = np.ones(num_interactions, dtype=np.float32)
 
-    for interaction in tqdm(all_interactions, total=len(all_interactions)):
-        user_id = interaction.user.id
-        movie_id = interaction.movie.id
-        rating = interaction.rating
+    # rows written after the count are left for the next load
+    rows = itertools.islice(query.yield_per(chunk_size), num_interactions)
+    num_loaded = 0
+    with tqdm(total=num_interactions) as progress:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if len(chunk) == 0:
+                break
+            chunk_users, chunk_items, chunk_ratings, _ = zip(*chunk)
+            end = num_loaded + len(chunk)
+            user_ids[num_loaded:end] = chunk_users
+            # movie_id is stored as a string column
+            item_ids[num_loaded:end] = np.array(chunk_items).astype(np.int64)
+            if not implicit:
+                ratings[num_loaded:end] = [1 if rating is None else rating for rating in chunk_ratings]
+            num_loaded = end
+            progress.update(len(chunk))
 
-        users.append(user_id)
-        items.append(movie_id)
-        ratings.append(1)   # implicit
+    user_ids, item_ids, ratings = user_ids[:num_loaded], item_ids[:num_loaded], ratings[:num_loaded]
 
-    rating_matrix = sp.csr_matrix((ratings, (users, items)))
+    max_user_id = users.query.with_entities(func.max(users.id)).scalar()
+    num_users = max(max_user_id if max_user_id is not None else -1, user_ids.max(initial=-1)) + 1
+    num_items = item_ids.max(initial=-1) + 1
+
+    rating_matrix = sp.csr_matrix((ratings, (user_ids, item_ids)), shape=(num_users, num_items), dtype=np.float32)
+    if implicit:
+        # repeated interactions with the same item count once
+        rating_matrix.data[:] = 1
     return rating_matrix
 
-def split_train_test(rating_matrix, test_ratio=0.1, shape=None):
+def latest_interaction_time(interactions):
+    """created_at of the newest interaction, the watermark of a matrix loaded now"""
+    return interactions.query.with_entities(func.max(interactions.created_at)).scalar()
+
+def load_interactions_since(interactions, watermark=None):
+    """
+    Interactions created after the watermark
+
+    Returns:
+        (binary csr matrix of the new interactions, created_at of the newest one),
+        or (None, watermark) when there is nothing new
+    """
+    query = interactions.query.with_entities(interactions.user_id, interactions.movie_id, interactions.created_at)
+    if watermark is None:
+        query = query.filter(interactions.created_at.isnot(None))
+    else:
+        query = query.filter(interactions.created_at > watermark)
+    rows = query.all()
+    if len(rows) == 0:
+        return None, watermark
+
+    users = np.array([row[0] for row in rows], dtype=np.int64)
+    items = np.array([int(row[1]) for row in rows], dtype=np.int64)
+    delta_matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (users, items)),
+                                 shape=(users.max() + 1, items.max() + 1))
+    delta_matrix.data[:] = 1
+    return delta_matrix, max(row[2] for row in rows)
+
+def contexts_to_matrix(contexts, num_items):
+    """Stack user contexts (lists of item ids) into one binary (len(contexts), num_items) csr matrix"""
+    lengths = [len(context) for context in contexts]
+    items = np.fromiter((item for context in contexts for item in context), dtype=np.int64, count=sum(lengths))
+    if len(items) > 0 and (items.min() < 0 or items.max() >= num_items):
+        raise ValueError(f'Item ids must be in [0, {num_items})')
+
+    indptr = np.zeros(len(contexts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    data = np.ones(len(items), dtype=np.float32)
+
+    context_matrix = sp.csr_matrix((data, items, indptr), shape=(len(contexts), num_items))
+    # repeated ids in a context are still a single interaction
+    context_matrix.sum_duplicates()
+    context_matrix.data[:] = 1
+    return context_matrix
+
+def load_interaction_timestamps(interactions, rating_matrix, chunk_size=100000):
+    """
+    Interaction.timestamp of every stored entry of rating_matrix, aligned with rating_matrix.data.
+    Interactions outside the matrix are ignored, entries without a timestamp get 0.
+    """
+    query = interactions.query.with_entities(interactions.user_id, interactions.movie_id, interactions.timestamp)
+    num_users, num_items = rating_matrix.shape
+
+    rows = np.repeat(np.arange(num_users, dtype=np.int64), np.diff(rating_matrix.indptr))
+    keys = rows * num_items + rating_matrix.indices
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    timestamps = np.zeros(rating_matrix.nnz, dtype=np.int64)
+    results = iter(query.yield_per(chunk_size))
+    while rating_matrix.nnz > 0:
+        chunk = list(itertools.islice(results, chunk_size))
+        if len(chunk) == 0:
+            break
+        chunk_users, chunk_items, chunk_timestamps = zip(*chunk)
+        chunk_users = np.array(chunk_users, dtype=np.int64)
+        chunk_items = np.array(chunk_items).astype(np.int64)
+        chunk_timestamps = np.array([0 if t is None else t for t in chunk_timestamps], dtype=np.int64)
+
+        inside = (chunk_users < num_users) & (chunk_items < num_items)
+        chunk_keys = chunk_users[inside] * num_items + chunk_items[inside]
+        positions = np.minimum(np.searchsorted(sorted_keys, chunk_keys), len(sorted_keys) - 1)
+        found = sorted_keys[positions] == chunk_keys
+        timestamps[order[positions[found]]] = chunk_timestamps[inside][found]
+    return timestamps
+
+def split_train_test(rating_matrix, test_ratio=0.1, shape=None, mode='random', timestamps=None,
+                     num_test=1, cutoff=None, seed=0):
+    """
+    Split every stored interaction of a csr matrix into train and test
+
+    Args:
+        rating_matrix: (users, items) csr matrix
+        test_ratio: Fraction of each user's interactions held out ('random'),
+            or of all interactions when no cutoff is given ('time_cutoff')
+        shape: Shape of the returned matrices (default: rating_matrix.shape)
+        mode: 'random' per-user holdout, 'leave_last' k newest interactions of each user,
+            or 'time_cutoff' every interaction at or after a timestamp
+        timestamps: Timestamp of each entry, aligned with rating_matrix.data ('leave_last', 'time_cutoff')
+        num_test: Interactions held out per user ('leave_last')
+        cutoff: First test timestamp ('time_cutoff')
+        seed: Seed of the sampling and tie breaking
+
+    Returns:
+        (train_matrix, test_matrix)
+    """
+    if mode not in ('random', 'leave_last', 'time_cutoff'):
+        raise ValueError("mode must be one of 'random', 'leave_last', 'time_cutoff'")
+    if mode != 'random' and timestamps is None:
+        raise ValueError(f"mode '{mode}' needs timestamps")
+
     if shape is None:
         shape = rating_matrix.shape
-    num_users, num_items = shape
-    train_data = {'users': [], 'items': [], 'ratings': []}
-    test_data = {'users': [], 'items': [], 'ratings': []}
-    for u in range(num_users):
-        # u_items = rating_matrix[u].indices
-        u_items = rating_matrix.indices[rating_matrix.indptr[u]: rating_matrix.indptr[u+1]]
-        # u_ratings = rating_matrix[u].values
-        num_test = int(len(u_items) * test_ratio)
-        test_idx = np.random.choice(list(range(len(u_items))), size=num_test)
-        for i in range(len(u_items)):
-            if i in test_idx:
-                test_data['users'].append(u)
-                test_data['items'].append(i)
-                test_data['ratings'].append(1.0)
-            else:
-                train_data['users'].append(u)
-                train_data['items'].append(i)
-                train_data['ratings'].append(1.0)
-    train_matrix = sp.csr_matrix((train_data['ratings'], (train_data['users'], train_data['items'])), shape=shape)
-    test_matrix = sp.csr_matrix((test_data['ratings'], (test_data['users'], test_data['items'])), shape=shape)
-    return train_matrix, test_matrix    
\ No newline at end of file
+    num_users = rating_matrix.shape[0]
+    indptr = rating_matrix.indptr
+    row_lengths = np.diff(indptr)
+    rows = np.repeat(np.arange(num_users), row_lengths)
+    rng = np.random.default_rng(seed)
+
+    if mode == 'time_cutoff':
+        if cutoff is None:
+            cutoff = np.quantile(timestamps, 1 - test_ratio)
+        is_test = np.asarray(timestamps) >= cutoff
+    else:
+        # rank the entries of every row: randomly, or newest first with random tie breaking
+        if mode == 'random':
+            age = np.zeros(rating_matrix.nnz, dtype=np.int64)
+            row_num_test = (row_lengths * test_ratio).astype(np.int64)
+        else:
+            timestamps = np.asarray(timestamps, dtype=np.int64)
+            age = timestamps.max(initial=0) - timestamps
+            row_num_test = np.minimum(row_lengths, num_test)
+
+        # one int64 sort key (row, age, random tie) when it fits, lexsort otherwise
+        num_ages = int(age.max(initial=0)) + 1
+        num_ties = 2**62 // (max(num_users, 1) * num_ages)
+        if num_ties > 1:
+            key = (rows * num_ages + age) * num_ties + rng.integers(num_ties, size=rating_matrix.nnz)
+            order = np.argsort(key)
+        else:
+            order = np.lexsort((rng.random(rating_matrix.nnz), age, rows))
+        rank = np.empty(rating_matrix.nnz, dtype=np.int64)
+        rank[order] = np.arange(rating_matrix.nnz) - indptr[rows[order]]
+        is_test = rank < row_num_test[rows]
+
+    def select(mask):
+        selected_indptr = np.zeros(shape[0] + 1, dtype=indptr.dtype)
+        selected_indptr[1:num_users + 1] = np.cumsum(np.bincount(rows[mask], minlength=num_users))
+        selected_indptr[num_users + 1:] = selected_indptr[num_users]
+        return sp.csr_matrix((rating_matrix.data[mask], rating_matrix.indices[mask], selected_indptr), shape=shape)
+
+    train_matrix = select(~is_test)
+    test_matrix = select(is_test)
+    return train_matrix, test_matrix
@@ -110,7 +110,7 @@ if __name__ == '__main__':
         user = user_id_map[row.user]
         item = item_id_map[row.item]
         rating = float(row.rating)
-        timestamp = int(row.rating)
+        timestamp = int(row.timestamp)
 
         user = User.query.filter_by(id=user).first()
         item = Movie.query.filter_by(id=item).first()